@@ -0,0 +1,534 @@
+"""
+Benchmark VideoThumbnailGenerator hoàn toàn offline
+
+- Tạo các file MP4 tổng hợp (nhiều độ phân giải, thời lượng, moov ở đầu/cuối file) bằng cv2.VideoWriter
+- Phục vụ qua HTTP server cục bộ (hỗ trợ Range) có giả lập độ trễ, băng thông và lỗi 503
+- Chạy generator end-to-end trên lưới concurrency x backend x fetch_mode, mỗi cấu hình
+  trong một process riêng để đo chính xác peak RSS và CPU
+- Ghi kết quả ra JSON để so sánh giữa các lần chạy (--baseline để phát hiện regression)
+
+Ví dụ:
+    python bench_thumb.py --videos 40 --concurrency 4 16 --backend thread process --fetch-mode stream range
+    python bench_thumb.py --baseline bench_results/bench_20260101_120000.json --max-regression 0.1
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import asyncio
+import argparse
+import platform
+import resource
+import threading
+import subprocess
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cv2
+import numpy as np
+
+from thumb import VideoThumbnailGenerator, _parse_mp4_box_header
+
+# Các box chứa box con cần duyệt khi sửa offset stco/co64
+_MP4_CONTAINER_BOXES = {'moov', 'trak', 'mdia', 'minf', 'stbl', 'edts', 'dinf', 'mvex', 'udta'}
+
+DEFAULT_RESOLUTIONS = ((640, 360), (1280, 720), (1920, 1080))
+DEFAULT_DURATIONS = (3, 10)
+DEFAULT_MOOV_PLACEMENTS = ("end", "start")
+
+
+def _shift_chunk_offsets(data, start, end, delta):
+    """Cộng delta vào mọi offset trong các box stco/co64 nằm trong data[start:end] (sửa tại chỗ)"""
+    pos = start
+    while pos + 8 <= end:
+        header = _parse_mp4_box_header(data, pos)
+        if header is None or not header[2]:
+            return
+        box_type, header_size, size = header
+        body = pos + header_size
+        if box_type in _MP4_CONTAINER_BOXES:
+            _shift_chunk_offsets(data, body, pos + size, delta)
+        elif box_type in ('stco', 'co64'):
+            count = struct.unpack('>I', data[body + 4:body + 8])[0]
+            fmt, width = ('>I', 4) if box_type == 'stco' else ('>Q', 8)
+            for i in range(count):
+                offset = body + 8 + i * width
+                value = struct.unpack(fmt, data[offset:offset + width])[0]
+                struct.pack_into(fmt, data, offset, value + delta)
+        pos += size
+
+
+def make_faststart(path):
+    """
+    Chuyển moov lên trước mdat (giống `ffmpeg -movflags +faststart`) và sửa lại offset các chunk
+
+    Returns:
+        bool: True nếu file đã được ghi lại
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    boxes = []
+    pos = 0
+    while pos < len(data):
+        header = _parse_mp4_box_header(data, pos)
+        if header is None:
+            break
+        box_type, _, size = header
+        size = size or (len(data) - pos)
+        boxes.append((box_type, pos, size))
+        pos += size
+    order = [box_type for box_type, _, _ in boxes]
+    if 'moov' not in order or 'mdat' not in order or order.index('moov') < order.index('mdat'):
+        return False
+    _, moov_pos, moov_size = boxes[order.index('moov')]
+    moov = bytearray(data[moov_pos:moov_pos + moov_size])
+    _shift_chunk_offsets(moov, 8, len(moov), moov_size)
+
+    # moov chèn ngay trước mdat: mdat (và mọi box sau nó) dời đi đúng moov_size byte
+    out = bytearray()
+    for box_type, box_pos, size in boxes:
+        if box_type == 'moov':
+            continue
+        if box_type == 'mdat':
+            out += moov
+        out += data[box_pos:box_pos + size]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(out)
+    os.replace(tmp_path, path)
+    return True
+
+
+def generate_video(path, size, duration, fps=25, moov="end", seed=0):
+    """
+    Tạo video tổng hợp có chuyển động (gradient, khối màu di chuyển, nhiễu) để encoder làm việc thật
+
+    Args:
+        size (tuple): (width, height)
+        duration (float): Thời lượng (giây)
+        moov (str): "end" (mặc định của cv2.VideoWriter) hoặc "start" (faststart)
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Không tạo được video {path}")
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    for index in range(int(duration * fps)):
+        frame = np.dstack([gradient, np.roll(gradient, index * 4, axis=1), np.full_like(gradient, (index * 3) % 256)])
+        x = (index * 7) % max(1, width - width // 4)
+        y = (index * 5) % max(1, height - height // 4)
+        cv2.rectangle(frame, (x, y), (x + width // 4, y + height // 4), (0, 0, 255), -1)
+        frame[::8, ::8] = rng.integers(0, 256, frame[::8, ::8].shape, dtype=np.uint8)
+        writer.write(frame)
+    writer.release()
+    if moov == "start":
+        make_faststart(path)
+
+
+def build_corpus(video_dir, resolutions=DEFAULT_RESOLUTIONS, durations=DEFAULT_DURATIONS,
+                 moov_placements=DEFAULT_MOOV_PLACEMENTS):
+    """
+    Tạo (hoặc dùng lại) bộ video tổng hợp cho mọi tổ hợp độ phân giải x thời lượng x vị trí moov
+
+    Returns:
+        list: Tên file trong video_dir
+    """
+    os.makedirs(video_dir, exist_ok=True)
+    names = []
+    for (width, height) in resolutions:
+        for duration in durations:
+            for moov in moov_placements:
+                name = f"synthetic_{width}x{height}_{duration}s_moov-{moov}.mp4"
+                path = os.path.join(video_dir, name)
+                if not os.path.exists(path):
+                    print(f"🎬 Tạo video {name}")
+                    generate_video(path, (width, height), duration, moov=moov, seed=len(names))
+                names.append(name)
+    return names
+
+
+class _VideoRequestHandler(BaseHTTPRequestHandler):
+    """Phục vụ file video với hỗ trợ Range, độ trễ, giới hạn băng thông và lỗi giả lập"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        # FFmpeg (cv2) gửi "Connection: close" và chỉ đọc đúng khi server xác nhận lại header này
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        server = self.server
+        path = os.path.join(server.video_dir, os.path.basename(self.path.split('?', 1)[0]))
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            server.count("errors_injected")
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        total = os.path.getsize(path)
+        start, end = 0, total - 1
+        status = 200
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[6:].split(",", 1)[0].partition("-")
+            if first:
+                start = int(first)
+                end = min(int(last), total - 1) if last else total - 1
+            elif last:
+                start = max(0, total - int(last))
+            if start >= total:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{total}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        chunk_size = 64 * 1024
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+                    server.count("bytes_sent", len(chunk))
+                    if server.bandwidth:
+                        # Giới hạn băng thông theo từng kết nối
+                        time.sleep(len(chunk) / server.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client (cv2/aiohttp) đóng kết nối sớm sau khi đã đủ dữ liệu
+            pass
+
+
+class LocalVideoServer(ThreadingHTTPServer):
+    """
+    HTTP server cục bộ thay cho CDN khi benchmark
+
+    Args:
+        video_dir (str): Thư mục chứa video
+        latency (float): Độ trễ (giây) thêm vào mỗi request
+        bandwidth (float): Băng thông tối đa mỗi kết nối (byte/giây, None = không giới hạn)
+        error_rate (float): Tỷ lệ request trả về 503 (kèm Retry-After: 0)
+    """
+    daemon_threads = True
+
+    def __init__(self, video_dir, latency=0.0, bandwidth=None, error_rate=0.0, port=0):
+        super().__init__(("127.0.0.1", port), _VideoRequestHandler)
+        self.video_dir = video_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.stats = {"requests": 0, "errors_injected": 0, "bytes_sent": 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    def count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _TimedGenerator(VideoThumbnailGenerator):
+    """Generator ghi lại thời gian end-to-end của từng video (tính cả thời gian chờ slot)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def create_thumbnail_async(self, video_url, title=None):
+        started = time.perf_counter()
+        try:
+            return await super().create_thumbnail_async(video_url, title)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+
+def _percentiles(values):
+    if not values:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+    return {"p50_ms": round(p50 * 1000, 2), "p95_ms": round(p95 * 1000, 2),
+            "p99_ms": round(p99 * 1000, 2), "max_ms": round(max(values) * 1000, 2)}
+
+
+def _cpu_seconds():
+    """Tổng CPU time (user + system) của process hiện tại và các process con đã kết thúc"""
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def _peak_rss_kb():
+    """
+    Peak RSS (KB) của process hiện tại từ /proc (Linux)
+
+    ru_maxrss của RUSAGE_SELF giữ giá trị của process cha qua exec nên không dùng được ở đây.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_single(config):
+    """
+    Chạy một cấu hình trong process hiện tại (được gọi qua --run-one trong process con)
+
+    Returns:
+        dict: Kết quả đo của cấu hình
+    """
+    work_dir = config["work_dir"]
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    csv_path = os.path.join(work_dir, "input.csv")
+    with open(csv_path, 'w', encoding='utf-8') as f:
+        f.write("url,title\n")
+        for index, url in enumerate(config["urls"]):
+            f.write(f"{url},bench [{index}]\n")
+
+    generator = _TimedGenerator(
+        output_dir=os.path.join(work_dir, "thumbnails"),
+        thumbnail_size=(320, 180),
+        concurrent_limit=config["concurrency"],
+        executor_backend=config["backend"],
+        fetch_mode=config["fetch_mode"],
+        retry_backoff=0.05,
+        retry_backoff_max=0.5,
+    )
+    cpu_before = _cpu_seconds()
+    started = time.perf_counter()
+    result_df = asyncio.run(generator.process_csv_batch_async(
+        csv_path, output_csv_path=os.path.join(work_dir, "output.csv")
+    ))
+    wall = time.perf_counter() - started
+
+    # CPU của cả process chính và các worker (process pool), chỉ tính trong lúc chạy generator
+    cpu = _cpu_seconds() - cpu_before
+    peak_rss_kb = _peak_rss_kb() or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    success = int((result_df['status'] == 'success').sum()) if result_df is not None else 0
+    videos = len(config["urls"])
+    result = {
+        "videos": videos,
+        "success": success,
+        "failed": videos - success,
+        "wall_s": round(wall, 3),
+        "throughput_vps": round(videos / wall, 3) if wall > 0 else 0.0,
+        "latency": _percentiles(generator.latencies),
+        "peak_rss_mb": round(peak_rss_kb / 1024, 1),
+        "peak_worker_rss_mb": round(usage_children.ru_maxrss / 1024, 1),
+        "cpu_s": round(cpu, 3),
+        "cpu_util": round(cpu / wall / (os.cpu_count() or 1), 3) if wall > 0 else 0.0,
+        "stages": generator.metrics.summary()["stages"],
+    }
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def run_grid(args):
+    """Chạy toàn bộ lưới cấu hình, mỗi cấu hình trong một process con riêng"""
+    names = build_corpus(args.video_dir)
+    server = LocalVideoServer(args.video_dir, latency=args.latency, bandwidth=args.bandwidth,
+                              error_rate=args.error_rate).start()
+    print(f"🌐 Server video cục bộ: {server.base_url} (latency {args.latency}s, "
+          f"bandwidth {args.bandwidth or 'không giới hạn'}, lỗi {args.error_rate:.0%})")
+    # Query string khác nhau để mỗi dòng là một URL riêng (như các video khác nhau trên CDN)
+    urls = [f"{server.base_url}{names[i % len(names)]}?v={i}" for i in range(args.videos)]
+
+    runs = []
+    try:
+        for backend in args.backend:
+            for fetch_mode in args.fetch_mode:
+                for concurrency in args.concurrency:
+                    for repeat in range(args.repeat):
+                        config = {
+                            "backend": backend,
+                            "fetch_mode": fetch_mode,
+                            "concurrency": concurrency,
+                            "urls": urls,
+                            "work_dir": os.path.join(args.output_dir, "work"),
+                        }
+                        before = dict(server.stats)
+                        # Config (kèm danh sách URL) đi qua stdin: argv bị giới hạn độ dài (MAX_ARG_STRLEN)
+                        completed = subprocess.run(
+                            [sys.executable, os.path.abspath(__file__), "--run-one"],
+                            input=json.dumps(config), capture_output=True, text=True
+                        )
+                        if completed.returncode != 0:
+                            print(f"❌ Cấu hình {backend}/{fetch_mode}/c{concurrency} lỗi:\n{completed.stderr[-2000:]}")
+                            continue
+                        result = json.loads(completed.stdout.strip().splitlines()[-1])
+                        result["server"] = {key: server.stats[key] - before[key] for key in server.stats}
+                        run = {"backend": backend, "fetch_mode": fetch_mode, "concurrency": concurrency,
+                               "repeat": repeat, **result}
+                        runs.append(run)
+                        print(f"📈 {backend:<7} {fetch_mode:<6} c={concurrency:<3} "
+                              f"{run['throughput_vps']:.2f} video/s - p50 {run['latency']['p50_ms']:.0f}ms - "
+                              f"p95 {run['latency']['p95_ms']:.0f}ms - p99 {run['latency']['p99_ms']:.0f}ms - "
+                              f"RSS {run['peak_rss_mb']:.0f}MB (+{run['peak_worker_rss_mb']:.0f}MB worker) - "
+                              f"CPU {run['cpu_util']:.0%} - thất bại {run['failed']}")
+    finally:
+        server.stop()
+
+    return {
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "environment": _environment(),
+        "params": {
+            "videos": args.videos,
+            "corpus": names,
+            "latency": args.latency,
+            "bandwidth": args.bandwidth,
+            "error_rate": args.error_rate,
+        },
+        "runs": runs,
+    }
+
+
+def _environment():
+    """Thông tin môi trường để so sánh kết quả giữa các máy/lần chạy"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "git_commit": commit,
+    }
+
+
+def compare_with_baseline(report, baseline_path, max_regression):
+    """
+    So sánh throughput và p95 với file kết quả cũ (theo backend/fetch_mode/concurrency)
+
+    Returns:
+        bool: True nếu không cấu hình nào tệ hơn ngưỡng max_regression
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    def best_runs(runs):
+        best = {}
+        for run in runs:
+            key = (run["backend"], run["fetch_mode"], run["concurrency"])
+            if key not in best or run["throughput_vps"] > best[key]["throughput_vps"]:
+                best[key] = run
+        return best
+
+    old_runs = best_runs(baseline.get("runs", []))
+    ok = True
+    print(f"\n=== SO SÁNH VỚI {baseline_path} ===")
+    for key, run in sorted(best_runs(report["runs"]).items()):
+        old = old_runs.get(key)
+        if old is None or not old["throughput_vps"]:
+            continue
+        throughput_change = run["throughput_vps"] / old["throughput_vps"] - 1
+        p95_change = (run["latency"]["p95_ms"] / old["latency"]["p95_ms"] - 1) if old["latency"]["p95_ms"] else 0.0
+        regressed = throughput_change < -max_regression or p95_change > max_regression
+        ok = ok and not regressed
+        print(f"{'❌' if regressed else '✅'} {key[0]:<7} {key[1]:<6} c={key[2]:<3} "
+              f"throughput {throughput_change:+.1%} - p95 {p95_change:+.1%}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark VideoThumbnailGenerator với server video cục bộ")
+    parser.add_argument("--videos", type=int, default=40, help="Số video (URL) mỗi lần chạy")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[4, 16])
+    parser.add_argument("--backend", nargs="+", default=["thread", "process"], choices=["thread", "process"])
+    parser.add_argument("--fetch-mode", nargs="+", default=["stream", "range"], choices=["stream", "range"])
+    parser.add_argument("--repeat", type=int, default=1, help="Số lần lặp mỗi cấu hình")
+    parser.add_argument("--latency", type=float, default=0.0, help="Độ trễ mỗi request (giây)")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Băng thông mỗi kết nối (byte/giây)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỷ lệ request trả về 503")
+    parser.add_argument("--video-dir", default=os.path.join("bench_results", "videos"))
+    parser.add_argument("--output-dir", default="bench_results")
+    parser.add_argument("--baseline", help="File JSON kết quả cũ để so sánh")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="Mức giảm throughput / tăng p95 tối đa cho phép khi so với baseline")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        # Process con: đọc config từ stdin, chỉ in JSON kết quả ở dòng cuối (log của generator đi ra stderr)
+        config = json.load(sys.stdin)
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        result = run_single(config)
+        sys.stdout = stdout
+        print(json.dumps(result))
+        return 0
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = run_grid(args)
+    output_path = os.path.join(args.output_dir, f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✓ Đã lưu kết quả benchmark vào: {output_path}")
+
+    if args.baseline and not compare_with_baseline(report, args.baseline, args.max_regression):
+        print("❌ Có cấu hình bị regression vượt ngưỡng")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
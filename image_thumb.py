@@ -0,0 +1,340 @@
+import os
+import io
+import json
+import math
+import asyncio
+from datetime import datetime
+from urllib.parse import urlparse
+
+import aiohttp
+import pandas as pd
+from PIL import Image, ImageOps
+
+from thumb import VideoThumbnailGenerator, TransientFetchError, PermanentFetchError, _atomic_write
+
+try:
+    # Chỉ cần khi xử lý các bộ ảnh đã mã hoá trong public/images
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+def _collection_cipher_key(key):
+    """Tạo khoá AES-256 giống App.js: lặp key cho đủ 32 ký tự rồi cắt"""
+    return (key * math.ceil(32 / len(key)))[:32].encode('utf-8')
+
+
+def decrypt_collection_image(data, key):
+    """Giải mã ảnh trong public/images (AES-256-CBC, 16 byte đầu là IV, padding PKCS7)"""
+    decryptor = Cipher(algorithms.AES(_collection_cipher_key(key)), modes.CBC(data[:16])).decryptor()
+    padded = decryptor.update(data[16:]) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return unpadder.update(padded) + unpadder.finalize()
+
+
+def encrypt_collection_image(data, key):
+    """Mã hoá thumbnail theo cùng định dạng để App.js giải mã như ảnh gốc"""
+    iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(data) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(_collection_cipher_key(key)), modes.CBC(iv)).encryptor()
+    return iv + encryptor.update(padded) + encryptor.finalize()
+
+
+class ImageThumbnailGenerator(VideoThumbnailGenerator):
+    """
+    Tạo thumbnail cho ảnh (img.txt và các bộ ảnh theo tag trong public/images)
+
+    Dùng chung scheduler cửa sổ trượt, manifest incremental, network layer theo host và
+    cpu executor với VideoThumbnailGenerator. Ảnh JPEG được decode ở kích thước giảm
+    (draft: scale 1/2, 1/4, 1/8 ngay trong lúc decode) thay vì decode full rồi mới resize.
+    """
+    RESULT_COLUMNS = VideoThumbnailGenerator.RESULT_COLUMNS + ('thumbnail_width', 'thumbnail_height')
+
+    def __init__(self, output_dir="public/thumbnails/img", thumbnail_size=(400, 400),
+                 web_path_prefix="/temporary/thumbnails/img/", collection_key=None, **kwargs):
+        """
+        Khởi tạo generator thumbnail ảnh
+
+        Args:
+            output_dir (str): Thư mục lưu thumbnail
+            thumbnail_size (tuple): Khung tối đa (width, height), ảnh giữ nguyên tỷ lệ, không thêm viền
+            web_path_prefix (str): Prefix web path của thumbnail
+            collection_key (str): Khoá giải mã ảnh local đã mã hoá (public/images); thumbnail
+                cũng được mã hoá lại bằng khoá này. None = ảnh local không mã hoá
+            **kwargs: Các tham số khác của VideoThumbnailGenerator (concurrent_limit, executor_backend, ...)
+        """
+        super().__init__(output_dir=output_dir, thumbnail_size=thumbnail_size,
+                         web_path_prefix=web_path_prefix, **kwargs)
+        if collection_key and Cipher is None:
+            raise ValueError("Cần cài 'cryptography' để xử lý ảnh đã mã hoá (pip install cryptography)")
+        self.collection_key = collection_key
+
+    def settings_fingerprint(self):
+        """Fingerprint cấu hình, thêm loại nguồn để không lẫn với manifest của video"""
+        return "img-" + super().settings_fingerprint()
+
+    def required_manifest_columns(self):
+        """Thumbnail ảnh không có placeholder lqip, chỉ cần kích thước ảnh gốc"""
+        return ('source_width',)
+
+    @staticmethod
+    def iter_csv_rows(csv_file_path, chunksize=1000):
+        """
+        Đọc img.txt (cột Filename, Url) hoặc CSV có sẵn cột url/title
+
+        Yields:
+            tuple: (idx, row) với row có 'url' và 'title'
+        """
+        idx = 0
+        for chunk in pd.read_csv(csv_file_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+            chunk = chunk.rename(columns={'Url': 'url', 'Filename': 'title'})
+            if 'url' not in chunk.columns:
+                raise ValueError("CSV phải có cột 'url' hoặc 'Url'")
+            if 'title' not in chunk.columns:
+                chunk['title'] = ''
+            for row in chunk.to_dict('records'):
+                yield idx, row
+                idx += 1
+
+    async def _fetch_image_once_async(self, image_url):
+        """
+        Tải ảnh (một lần thử). File local trả về nguyên đường dẫn để worker tự đọc
+
+        Returns:
+            bytes hoặc str: Nội dung ảnh hoặc đường dẫn file local
+        """
+        if urlparse(image_url).scheme not in ("http", "https"):
+            return image_url
+        try:
+            async with self.host_limiter.limit(urlparse(image_url).netloc):
+                async with self.http_session.get(image_url) as response:
+                    self._raise_for_status(response)
+                    return await response.read()
+        except asyncio.TimeoutError:
+            raise TransientFetchError("timeout")
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            raise TransientFetchError(f"lỗi kết nối: {str(e)}")
+
+    async def create_thumbnail_async(self, image_url, title=None):
+        """
+        Tạo thumbnail cho một ảnh (async)
+
+        Returns:
+            dict: {"success": bool, "thumbnail_path": str, "web_path": str, "error": str, kích thước ...}
+        """
+        try:
+            try:
+                source = await self._retry_async(image_url, lambda: self._fetch_image_once_async(image_url))
+            except PermanentFetchError as e:
+                return {"success": False, "thumbnail_path": None, "error": f"Lỗi HTTP: {str(e)}",
+                        "error_category": "http_permanent"}
+            if source is None:
+                return {"success": False, "thumbnail_path": None, "error": "Không thể tải ảnh"}
+
+            async with self.cpu_semaphore:
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(
+                    self.cpu_executor,
+                    self._process_image_sync,
+                    source,
+                    image_url,
+                    title
+                )
+
+        except Exception as e:
+            error_msg = f"Lỗi khi tạo thumbnail: {str(e)}"
+            print(f"✗ {image_url}: {error_msg}")
+            return {"success": False, "thumbnail_path": None, "error": error_msg}
+
+    def _process_image_sync(self, source, image_url, title):
+        """Decode ảnh ở kích thước giảm, resize và lưu thumbnail (chạy trong cpu executor)"""
+        try:
+            encrypted = False
+            if isinstance(source, str):
+                with open(source, 'rb') as f:
+                    data = f.read()
+                encrypted = self.collection_key is not None
+                if encrypted:
+                    data = decrypt_collection_image(data, self.collection_key)
+            else:
+                data = source
+
+            image = Image.open(io.BytesIO(data))
+            source_w, source_h = image.size
+            # Ảnh chụp điện thoại xoay bằng EXIF: kích thước hiển thị bị đảo chiều
+            if image.getexif().get(0x0112) in (5, 6, 7, 8):
+                source_w, source_h = source_h, source_w
+
+            # JPEG: decode thẳng ở scale 1/2, 1/4, 1/8 (vẫn >= khung thumbnail), không decode full
+            image.draft('RGB', tuple(self.thumbnail_size))
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail(tuple(self.thumbnail_size), Image.LANCZOS)
+
+            output = self.encoder.encode_pil(image)
+            if encrypted:
+                output = encrypt_collection_image(output, self.collection_key)
+
+            name = None
+            if self.storage_layout == "flat":
+                name = self.clean_filename(title or os.path.splitext(os.path.basename(urlparse(image_url).path))[0]) or "image"
+            filepath = self.store.path_for(image_url, self.encoder.extension, name)
+            _atomic_write(filepath, output)
+
+            web_path = self.store.web_path(filepath)
+            print(f"✓ Đã tạo thumbnail: {os.path.basename(filepath)}")
+            return {
+                "success": True,
+                "thumbnail_path": filepath,
+                "web_path": web_path,
+                "error": None,
+                "format": self.image_format,
+                "source_width": source_w,
+                "source_height": source_h,
+                "thumbnail_width": image.width,
+                "thumbnail_height": image.height,
+            }
+
+        except Exception as e:
+            error_msg = f"Lỗi khi xử lý ảnh: {str(e)}"
+            return {"success": False, "thumbnail_path": None, "error": error_msg}
+
+    async def process_collections_async(self, images_dir="public/images", output_json=None, output_csv=None):
+        """
+        Tạo thumbnail cho các bộ ảnh theo tag (images_dir/<TAG>/ + data.json)
+
+        Ghi data_thumbs.json: cấu trúc như data.json, mỗi tag thêm danh sách "thumbnails"
+        (file gốc, web path thumbnail và kích thước) cùng một CSV kết quả.
+
+        Args:
+            images_dir (str): Thư mục chứa data.json và các thư mục tag
+            output_json (str): File JSON đầu ra (mặc định: <images_dir>/data_thumbs.json)
+            output_csv (str): File CSV kết quả (mặc định: <images_dir>/data_thumbs.csv)
+
+        Returns:
+            list: Nội dung data_thumbs.json hoặc None nếu lỗi
+        """
+        try:
+            output_json = output_json or os.path.join(images_dir, "data_thumbs.json")
+            output_csv = output_csv or os.path.join(images_dir, "data_thumbs.csv")
+            with open(os.path.join(images_dir, "data.json"), 'r', encoding='utf-8') as f:
+                collections = json.load(f)
+
+            rows = []
+            for collection in collections:
+                for file in collection['files']:
+                    rows.append({
+                        'url': os.path.join(images_dir, collection['tag'], file),
+                        'title': f"{collection['tag']}_{os.path.splitext(file)[0]}",
+                        'tag': collection['tag'],
+                        'file': file,
+                    })
+            print(f"📁 Tìm thấy {len(rows)} ảnh trong {len(collections)} tag")
+
+            results = {}
+            async for idx, row, result in self.iter_results_async(enumerate(rows)):
+                results[idx] = result
+
+            records = []
+            thumbnails_by_tag = {}
+            for idx, row in enumerate(rows):
+                result = results[idx]
+                record = dict(row)
+                record['web_path'] = result.get('web_path') or ''
+                record['thumbnail_path'] = result.get('thumbnail_path') or ''
+                record['status'] = 'success' if result['success'] else 'failed'
+                record['error'] = result.get('error') or ''
+                record.update(self._extra_result_columns(result))
+                records.append(record)
+                if result['success']:
+                    thumbnails_by_tag.setdefault(row['tag'], []).append({
+                        "file": row['file'],
+                        "thumbnail": result['web_path'],
+                        "width": result['source_width'],
+                        "height": result['source_height'],
+                        "thumbnail_width": result['thumbnail_width'],
+                        "thumbnail_height": result['thumbnail_height'],
+                    })
+
+            augmented = [
+                dict(collection, thumbnails=thumbnails_by_tag.get(collection['tag'], []))
+                for collection in collections
+            ]
+            _atomic_write(output_json, json.dumps(augmented, ensure_ascii=False, indent=2).encode('utf-8'))
+            self.save_results_to_csv(pd.DataFrame(records, dtype=object), output_csv)
+            print(f"✓ Đã lưu {output_json}")
+            return augmented
+
+        except Exception as e:
+            print(f"Lỗi khi xử lý bộ ảnh: {str(e)}")
+            return None
+        finally:
+            await self.close_async()
+
+
+async def process_img_txt():
+    """Xử lý file img.txt và lưu kết quả vào img.csv"""
+    try:
+        input_file = "public/img.txt"
+        output_csv = "img.csv"
+        if not os.path.exists(input_file):
+            print(f"❌ Không tìm thấy file {input_file}")
+            return
+
+        generator = ImageThumbnailGenerator(
+            output_dir="public/thumbnails/img",
+            thumbnail_size=(400, 400),
+            concurrent_limit=16,
+            web_path_prefix="/temporary/thumbnails/img/",
+            manifest_path="img_manifest.json",
+            executor_backend="process",
+            storage_layout="hashed"
+        )
+        result_df = await generator.process_csv_batch_async(
+            csv_file_path=input_file,
+            incremental=True,
+            output_csv_path=output_csv
+        )
+        if result_df is not None:
+            print(f"\n✅ Hoàn thành! Kết quả CSV: {output_csv} (Tổng {len(result_df)} dòng)")
+        else:
+            print("❌ Có lỗi xảy ra trong quá trình xử lý")
+    except Exception as e:
+        print(f"❌ Lỗi: {str(e)}")
+
+
+async def process_image_collections():
+    """Xử lý các bộ ảnh trong public/images (cần IMAGE_COLLECTION_KEY để giải mã)"""
+    key = os.environ.get("IMAGE_COLLECTION_KEY")
+    if not key:
+        print("⏭️  Bỏ qua public/images: chưa đặt IMAGE_COLLECTION_KEY (ảnh đã được mã hoá)")
+        return
+    try:
+        generator = ImageThumbnailGenerator(
+            output_dir="public/images/thumbs",
+            thumbnail_size=(400, 400),
+            web_path_prefix="/temporary/images/thumbs/",
+            collection_key=key
+        )
+    except Exception as e:
+        print(f"❌ Lỗi khi khởi tạo generator: {str(e)}")
+        return
+    await generator.process_collections_async("public/images")
+
+
+if __name__ == "__main__":
+    start_time = datetime.now()
+    print(f"=== BẮT ĐẦU CHẠY SCRIPT THUMBNAIL ẢNH ({start_time.strftime('%Y-%m-%d %H:%M:%S')}) ===")
+    try:
+        asyncio.run(process_img_txt())
+        asyncio.run(process_image_collections())
+    except Exception as e:
+        print(f"❌ Lỗi khi chạy script: {str(e)}")
+    finally:
+        end_time = datetime.now()
+        duration = end_time - start_time
+        print(f"\n=== KẾT THÚC SCRIPT THUMBNAIL ẢNH ({end_time.strftime('%Y-%m-%d %H:%M:%S')}) ===")
+        print(f"Tổng thời gian chạy: {duration.total_seconds():.2f} giây")
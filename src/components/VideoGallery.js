@@ -1,7 +1,13 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import Papa from 'papaparse';
 import '../styles/VideoGallery.css';
 
+// Paginated index written by thumb.py (GalleryIndexBuilder)
+const INDEX_URL = '/temporary/vid-index/';
+
+// MIME types for thumbnails sliced out of a pack
+const THUMBNAIL_TYPES = { jpg: 'image/jpeg', jpeg: 'image/jpeg', webp: 'image/webp', avif: 'image/avif' };
+
 const VideoGallery = () => {
   const [allVideos, setAllVideos] = useState([]);
   const [currentPage, setCurrentPage] = useState(() => {
@@ -36,46 +42,96 @@ const VideoGallery = () => {
   const [searchTerm, setSearchTerm] = useState('');
   const [isRegexSearch, setIsRegexSearch] = useState(false);
   const [filteredVideos, setFilteredVideos] = useState([]);
+  const [packedThumbnails, setPackedThumbnails] = useState({});
+  const packRequests = useRef(new Map());
+  const pendingThumbnails = useRef(new Set());
+  const objectUrls = useRef([]);
+  const isMountedRef = useRef(true);
   
   useEffect(() => {
     let isMounted = true;
     
-    // Load videos from CSV file
-    fetch('/temporary/vid.csv')
-      .then(response => {
-        if (!response.ok) throw new Error('Cannot load CSV file: ' + response.statusText);
-        return response.text();
-      })
-      .then(data => {
-        if (!data.trim()) {
-          console.error('Empty CSV file. Please check the file.');
-          return;
-        }
-        Papa.parse(data, {
-          header: true,
-          skipEmptyLines: true,
-          complete: function(results) {
-            if (!isMounted) return;
-            const validVideos = results.data.filter(video => video.url && video.title);
-            if (validVideos.length === 0) {
-              console.error('No valid videos found in CSV file.');
-              return;
-            }
-            setAllVideos(validVideos);
-            setFilteredVideos(validVideos); // Initialize filtered videos
-            setTotalPages(Math.ceil(validVideos.length / videosPerPage));
-            restoreViewState();
-          },
-          error: function(error) {
-            if (!isMounted) return;
-            console.error('Error parsing CSV: ' + error.message);
-          }
+    // Load the paginated index: a small manifest plus compact JSON shards.
+    // The shard holding the current page is fetched first so page 1 renders
+    // without waiting for the rest; the remaining shards fill in afterwards.
+    const loadIndex = async () => {
+      const response = await fetch(`${INDEX_URL}manifest.json`, { cache: 'no-cache' });
+      if (!response.ok) throw new Error('Cannot load gallery index: ' + response.statusText);
+      const manifest = await response.json();
+      if (!manifest.total || !manifest.shards || manifest.shards.length === 0) {
+        throw new Error('Empty gallery index.');
+      }
+
+      // Slots for rows that are not loaded yet stay null
+      const videos = new Array(manifest.total).fill(null);
+      const loadShard = async (shard) => {
+        const shardResponse = await fetch(shard.url);
+        if (!shardResponse.ok) throw new Error('Cannot load gallery shard: ' + shard.url);
+        const data = await shardResponse.json();
+        data.rows.forEach((row, i) => {
+          const video = {};
+          data.fields.forEach((field, j) => { video[field] = row[j]; });
+          videos[data.offset + i] = video;
         });
-      })
-      .catch(error => {
         if (!isMounted) return;
-        console.error('Error loading CSV file: ' + error.message);
-      });
+        setAllVideos(videos.slice());
+      };
+
+      setTotalPages(Math.ceil(manifest.total / videosPerPage));
+      const firstIndex = Math.min(
+        manifest.shards.length - 1,
+        Math.floor(((currentPage - 1) * videosPerPage) / manifest.shard_size)
+      );
+      await loadShard(manifest.shards[firstIndex]);
+      if (!isMounted) return;
+      restoreViewState();
+      await Promise.all(manifest.shards.filter((_, i) => i !== firstIndex).map(loadShard));
+    };
+
+    const loadCsv = () => {
+      // Fallback: load the full CSV file
+      fetch('/temporary/vid.csv')
+        .then(response => {
+          if (!response.ok) throw new Error('Cannot load CSV file: ' + response.statusText);
+          return response.text();
+        })
+        .then(data => {
+          if (!data.trim()) {
+            console.error('Empty CSV file. Please check the file.');
+            return;
+          }
+          Papa.parse(data, {
+            header: true,
+            skipEmptyLines: true,
+            complete: function(results) {
+              if (!isMounted) return;
+              const validVideos = results.data.filter(video => video.url && video.title);
+              if (validVideos.length === 0) {
+                console.error('No valid videos found in CSV file.');
+                return;
+              }
+              setAllVideos(validVideos);
+              setFilteredVideos(validVideos); // Initialize filtered videos
+              setTotalPages(Math.ceil(validVideos.length / videosPerPage));
+              restoreViewState();
+            },
+            error: function(error) {
+              if (!isMounted) return;
+              console.error('Error parsing CSV: ' + error.message);
+            }
+          });
+        })
+        .catch(error => {
+          if (!isMounted) return;
+          console.error('Error loading CSV file: ' + error.message);
+        });
+    };
+
+    loadIndex().catch(error => {
+      if (!isMounted) return;
+      console.warn('Gallery index unavailable, falling back to CSV: ' + error.message);
+      loadCsv();
+    });
       
     return () => {
       isMounted = false;
@@ -93,32 +149,92 @@ const VideoGallery = () => {
     if (isRegexSearch) {
       try {
         const regex = new RegExp(searchTerm, 'i');
-        filtered = allVideos.filter(video => regex.test(video.title));
+        filtered = allVideos.filter(video => video && regex.test(video.title));
       } catch (error) {
         console.error('Invalid regex pattern:', error);
         // If regex is invalid, fall back to normal search
         filtered = allVideos.filter(video => 
-          video.title.toLowerCase().includes(searchTerm.toLowerCase())
+          video && video.title.toLowerCase().includes(searchTerm.toLowerCase())
         );
       }
     } else {
       filtered = allVideos.filter(video => 
-        video.title.toLowerCase().includes(searchTerm.toLowerCase())
+        video && video.title.toLowerCase().includes(searchTerm.toLowerCase())
       );
     }
     
     setFilteredVideos(filtered);
-    // Reset to first page when search changes
-    setCurrentPage(1);
   }, [searchTerm, isRegexSearch, allVideos]);
   
+  // Reset to first page when the search changes. Done in the handlers rather than
+  // an effect so loading more shards or restoring ?page= on mount keeps the page.
+  const handleSearchChange = (value) => {
+    setSearchTerm(value);
+    setCurrentPage(1);
+  };
+
   // Get current videos for pagination
   const getCurrentVideos = () => {
     const indexOfLastVideo = currentPage * videosPerPage;
     const indexOfFirstVideo = indexOfLastVideo - videosPerPage;
-    return filteredVideos.slice(indexOfFirstVideo, indexOfLastVideo);
+    // Rows of shards that are still loading are null
+    return filteredVideos.slice(indexOfFirstVideo, indexOfLastVideo).filter(Boolean);
   };
   
+  // Release object URLs created for packed thumbnails
+  useEffect(() => {
+    isMountedRef.current = true;
+    return () => {
+      isMountedRef.current = false;
+      objectUrls.current.forEach(url => URL.revokeObjectURL(url));
+      objectUrls.current = [];
+    };
+  }, []);
+  
+  // Load the thumbnails of the current page from their pack: one request per
+  // page instead of one per thumbnail. Falls back to web_path if a pack fails.
+  useEffect(() => {
+    const byPack = {};
+    getCurrentVideos()
+      .filter(video => video.pack_url && video.web_path && !packedThumbnails[video.url]
+        && !pendingThumbnails.current.has(video.url))
+      .forEach(video => {
+        pendingThumbnails.current.add(video.url);
+        (byPack[video.pack_url] = byPack[video.pack_url] || []).push(video);
+      });
+
+    Object.entries(byPack).forEach(([packUrl, members]) => {
+      if (!packRequests.current.has(packUrl)) {
+        packRequests.current.set(packUrl, fetch(packUrl).then(response => {
+          if (!response.ok) throw new Error('Cannot load thumbnail pack: ' + response.statusText);
+          return response.arrayBuffer();
+        }));
+      }
+      packRequests.current.get(packUrl)
+        .then(buffer => {
+          const urls = {};
+          members.forEach(video => {
+            const offset = Number(video.pack_offset);
+            const type = THUMBNAIL_TYPES[video.web_path.split('.').pop().toLowerCase()] || 'image/jpeg';
+            const url = URL.createObjectURL(new Blob([buffer.slice(offset, offset + Number(video.pack_size))], { type }));
+            objectUrls.current.push(url);
+            urls[video.url] = url;
+          });
+          return urls;
+        })
+        .catch(error => {
+          console.warn('Falling back to individual thumbnails: ' + error.message);
+          packRequests.current.delete(packUrl);
+          return Object.fromEntries(members.map(video => [video.url, video.web_path]));
+        })
+        .then(urls => {
+          members.forEach(video => pendingThumbnails.current.delete(video.url));
+          if (!isMountedRef.current) return;
+          setPackedThumbnails(previous => ({ ...previous, ...urls }));
+        });
+    });
+  }, [currentPage, filteredVideos]);
+  
   // Save view state when page changes
   useEffect(() => {
     saveViewState();
@@ -317,11 +433,11 @@ const VideoGallery = () => {
             className="search-input"
             placeholder={isRegexSearch ? "Search with regex..." : "Search videos..."}
             value={searchTerm}
-            onChange={(e) => setSearchTerm(e.target.value)}
+            onChange={(e) => handleSearchChange(e.target.value)}
           />
           <button 
             className="clear-search-button"
-            onClick={() => setSearchTerm('')}
+            onClick={() => handleSearchChange('')}
             style={{ display: searchTerm ? 'block' : 'none' }}
           >
             ✕
@@ -331,7 +447,10 @@ const VideoGallery = () => {
           <input
             type="checkbox"
             checked={isRegexSearch}
-            onChange={() => setIsRegexSearch(!isRegexSearch)}
+            onChange={() => {
+              setIsRegexSearch(!isRegexSearch);
+              setCurrentPage(1);
+            }}
           />
           Use Regex
         </label>
@@ -388,9 +507,11 @@ const VideoGallery = () => {
               {video.web_path ? (
                 <div className="thumbnail-image-container">
                   <img 
-                    src={video.web_path} 
+                    src={packedThumbnails[video.url] || (video.pack_url ? undefined : video.web_path)} 
                     alt={video.title}
                     className="thumbnail-image"
+                    // Inline low-quality placeholder shown until the real thumbnail arrives
+                    style={video.lqip ? { backgroundImage: `url(${video.lqip})`, backgroundSize: '100% 100%' } : undefined}
                     onError={(e) => {
                       // Fallback to video if thumbnail fails to load
                       e.target.style.display = 'none';
@@ -1,7 +1,7 @@
 import cv2
 import requests
 import numpy as np
-from PIL import Image
+from PIL import Image, features
 import os
 import sys
 import asyncio
@@ -10,10 +10,1693 @@ from urllib.parse import urlparse
 import time
 import pandas as pd
 import re
+import json
+import hashlib
+import struct
+import tempfile
+import random
+import contextlib
+import functools
+import argparse
+import cProfile
+import io
+import base64
+import gzip
+import signal
+import multiprocessing
+import mmap
+import abc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 from datetime import datetime
 
+try:
+    import brotli  # Tùy chọn: có thì ghi thêm bản .br cho gallery index
+except ImportError:
+    brotli = None
+
+# Generator dùng trong process con của cpu executor (được gán bởi _init_process_worker)
+_WORKER_GENERATOR = None
+
+
+def _worker_mp_context():
+    """
+    Context multiprocessing cho process con: forkserver (preload cv2/numpy), spawn nếu không có
+
+    Không dùng fork mặc định: process cha đã có thread aiohttp/I/O đang chạy, fork giữa chừng có thể
+    để lại lock bị giữ vĩnh viễn trong process con.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["cv2", "numpy"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def _init_process_worker(generator):
+    """Initializer cho process pool: giữ bản sao cấu hình generator trong process con"""
+    global _WORKER_GENERATOR
+    _WORKER_GENERATOR = generator
+
+
+def _frame_to_shared_memory(frame):
+    """
+    Copy frame vào một block shared memory để chuyển sang process con mà không pickle mảng
+
+    Returns:
+        tuple: (SharedMemory, frame_ref) - process cha giữ SharedMemory để unlink sau khi xong
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(frame.nbytes, 1))
+    np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[...] = frame
+    return shm, (shm.name, frame.shape, frame.dtype.str)
+
+
+def _process_frame_worker(frame_refs, video_url, title):
+    """
+    Chạy trong process con: map các mảng từ shared memory rồi gọi _process_frame_sync
+
+    Args:
+        frame_refs (dict): {"frame": frame_ref, "storyboard": frame_ref hoặc None}
+    """
+    blocks = []
+    arrays = {}
+    try:
+        for key, frame_ref in frame_refs.items():
+            if frame_ref is None:
+                arrays[key] = None
+                continue
+            name, shape, dtype = frame_ref
+            shm = shared_memory.SharedMemory(name=name)
+            # Process con dùng chung resource tracker với process cha (cha unlink và huỷ đăng ký),
+            # nên không unregister ở đây: huỷ đăng ký hai lần làm tracker báo KeyError
+            blocks.append(shm)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        return _WORKER_GENERATOR._process_frame_sync(
+            arrays['frame'], video_url, title, storyboard=arrays.get('storyboard')
+        )
+    finally:
+        arrays.clear()
+        for shm in blocks:
+            shm.close()
+
+
+class RangeFetchUnsupported(Exception):
+    """Server/định dạng không hỗ trợ lấy một phần file (sẽ fallback về đọc stream trực tiếp)"""
+
+
+class TransientFetchError(Exception):
+    """Lỗi mạng tạm thời (timeout, 5xx, 429) - có thể thử lại"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PermanentFetchError(Exception):
+    """Lỗi không thể khắc phục bằng cách thử lại (404, 403, ...)"""
+
+
+class DecodeTimeoutError(TransientFetchError):
+    """Một bước decode (open/seek/read/...) hoặc cả lần decode video vượt quá deadline"""
+
+    def __init__(self, stage, seconds):
+        super().__init__(f"timeout ở bước {stage} (>{seconds:g}s)")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class HostRateLimiter:
+    """
+    Giới hạn theo từng host: số request đồng thời tối đa và tốc độ request (token bucket)
+
+    Args:
+        max_concurrency (int): Số request đồng thời tối đa tới một host
+        rate (float): Số request/giây tối đa tới một host (None = không giới hạn)
+        burst (int): Số request được phép dồn một lúc (mặc định bằng max_concurrency)
+    """
+
+    def __init__(self, max_concurrency=8, rate=None, burst=None):
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst or max_concurrency
+        self._hosts = {}
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = {
+                'semaphore': asyncio.Semaphore(self.max_concurrency),
+                'lock': asyncio.Lock(),
+                'tokens': float(self.burst),
+                'updated': time.monotonic(),
+            }
+            self._hosts[host] = state
+        return state
+
+    async def _take_token(self, state):
+        if not self.rate:
+            return
+        async with state['lock']:
+            while True:
+                now = time.monotonic()
+                state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+                state['updated'] = now
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return
+                await asyncio.sleep((1 - state['tokens']) / self.rate)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, host):
+        """Chiếm một slot của host và chờ tới lượt theo rate trước khi gửi request"""
+        state = self._state(host)
+        async with state['semaphore']:
+            await self._take_token(state)
+            yield
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Giới hạn số job đồng thời tự điều chỉnh theo AIMD (như điều khiển nghẽn của TCP)
+
+    Dùng thay asyncio.Semaphore (`async with limiter:`). Sau mỗi cửa sổ quan sát
+    (ít nhất max(10, limit) lần xong), bộ điều khiển:
+      - giảm nhân (x decrease_factor) khi tỷ lệ lỗi tạm thời (timeout, 429, 5xx) vượt error_threshold;
+      - giảm nhẹ (x 0.9) khi latency p50 vượt latency_tolerance lần latency nền (hàng đợi phía server đang dài ra);
+      - tăng cộng (+1) khi mọi thứ ổn và giới hạn hiện tại thực sự bị dùng hết.
+    Latency nền là p50 thấp nhất từng thấy, trôi lên chậm để theo kịp thay đổi theo giờ trong ngày.
+    Mọi lần điều chỉnh được in ra và lưu trong history để kiểm tra lại.
+
+    Args:
+        initial (int): Giới hạn ban đầu
+        min_limit (int): Giới hạn nhỏ nhất
+        max_limit (int): Giới hạn lớn nhất
+        error_types (tuple): Các exception được tính là lỗi do quá tải
+        error_threshold (float): Tỷ lệ lỗi trong cửa sổ để giảm giới hạn
+        latency_tolerance (float): Hệ số latency p50 / latency nền để giảm giới hạn
+        decrease_factor (float): Hệ số giảm khi có lỗi
+        on_adjust (callable): Hàm gọi sau mỗi lần điều chỉnh với dict thông tin điều chỉnh
+    """
+
+    # Số lần điều chỉnh gần nhất giữ lại trong history
+    HISTORY_SIZE = 500
+
+    def __init__(self, initial=10, min_limit=2, max_limit=64, error_types=(Exception,), error_threshold=0.05,
+                 latency_tolerance=2.0, decrease_factor=0.7, on_adjust=None):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError("Cần 1 <= min_limit <= max_limit")
+        self.limit = max(min_limit, min(max_limit, initial))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.error_types = error_types
+        self.error_threshold = error_threshold
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.on_adjust = on_adjust
+        self.history = []
+        self.in_flight = 0
+        self._waiters = []
+        # Thời điểm bắt đầu của job đang chạy, theo task
+        self._started = {}
+        self._baseline = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self._latencies = []
+        self._errors = 0
+        self._saturated = False
+
+    async def __aenter__(self):
+        if self.in_flight >= self.limit or self._waiters:
+            future = asyncio.get_event_loop().create_future()
+            self._waiters.append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future in self._waiters:
+                    self._waiters.remove(future)
+                elif future.done() and not future.cancelled():
+                    # Đã được nhường slot nhưng bị huỷ: trả slot lại cho người khác
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+        else:
+            self.in_flight += 1
+        if self.in_flight >= self.limit:
+            self._saturated = True
+        self._started[asyncio.current_task()] = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        started = self._started.pop(asyncio.current_task(), None)
+        self.in_flight -= 1
+        if exc_type is not None and issubclass(exc_type, self.error_types):
+            self._errors += 1
+            self._latencies.append(None)
+        elif started is not None and not (exc_type is not None and issubclass(exc_type, asyncio.CancelledError)):
+            self._latencies.append(time.perf_counter() - started)
+        if len(self._latencies) >= max(10, self.limit):
+            self._evaluate()
+        self._wake()
+        return False
+
+    def _wake(self):
+        """Nhường slot cho các job đang chờ (FIFO) khi còn chỗ dưới giới hạn"""
+        while self._waiters and self.in_flight < self.limit:
+            future = self._waiters.pop(0)
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def _evaluate(self):
+        """Kết thúc một cửa sổ quan sát và điều chỉnh giới hạn"""
+        samples = [latency for latency in self._latencies if latency is not None]
+        error_rate = self._errors / len(self._latencies)
+        p50 = float(np.median(samples)) if samples else None
+        old_limit = self.limit
+        reason = None
+        if error_rate > self.error_threshold:
+            self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+            reason = "lỗi"
+        elif p50 is not None and self._baseline is not None and p50 > self._baseline * self.latency_tolerance:
+            self.limit = max(self.min_limit, int(self.limit * 0.9))
+            reason = "latency"
+        elif self._saturated and self.limit < self.max_limit:
+            self.limit += 1
+            reason = "tăng"
+        if p50 is not None:
+            # Latency nền: p50 thấp nhất, trôi lên 2% mỗi cửa sổ để không bị kẹt ở một giá trị cũ
+            self._baseline = p50 if self._baseline is None else min(p50, self._baseline * 1.02)
+        self._reset_window()
+
+        if reason is not None and self.limit != old_limit:
+            adjustment = {
+                "time": datetime.now().isoformat(timespec='seconds'),
+                "old": old_limit,
+                "new": self.limit,
+                "reason": reason,
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "baseline_ms": round(self._baseline * 1000, 1) if self._baseline is not None else None,
+                "error_rate": round(error_rate, 3),
+            }
+            self.history.append(adjustment)
+            del self.history[:-self.HISTORY_SIZE]
+            print(f"🎚️  Concurrency {old_limit} → {self.limit} ({reason}: p50 {adjustment['p50_ms']}ms, "
+                  f"nền {adjustment['baseline_ms']}ms, lỗi {error_rate:.0%})")
+            if self.on_adjust is not None:
+                self.on_adjust(adjustment)
+
+
+def _decode_worker_main(generator, conn):
+    """
+    Vòng lặp của worker decode có giám sát (chạy trong process con)
+
+    Nhận job (video_url, timestamp) qua pipe, báo bước đang chạy bằng message ("stage", tên)
+    để process cha tính deadline từng bước, cuối cùng gửi ("done", capture) hoặc ("timeout", ...).
+    Frame/storyboard của capture được ghi vào shared memory, qua pipe chỉ gửi tên/shape/dtype.
+    """
+    # Ctrl+C do process cha xử lý (cha sẽ dừng worker), worker không tự thoát giữa chừng
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    generator._stage_callback = lambda stage: conn.send(("stage", stage))
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            capture = generator._extract_frame_sync(*job)
+            if capture is not None:
+                # Frame không đi qua pipe: ghi vào shared memory, chỉ gửi tên/shape/dtype;
+                # process cha nhận quyền sở hữu block (dùng tiếp cho cpu executor rồi unlink)
+                refs = {}
+                for key in ("frame", "storyboard"):
+                    if capture.get(key) is not None:
+                        shm, refs[key] = _frame_to_shared_memory(capture[key])
+                        shm.close()
+                    capture[key] = None
+                capture["frame_refs"] = refs
+            conn.send(("done", capture))
+        except DecodeTimeoutError as e:
+            conn.send(("timeout", (e.stage, e.seconds)))
+
+
+def _attach_shared_capture(capture):
+    """
+    Map frame/storyboard mà worker decode đã ghi vào shared memory thành mảng numpy (không copy)
+
+    Các block giữ trong capture["shared_memory"] ({key: (SharedMemory, frame_ref)}) để cpu executor
+    dùng lại ref, và được unlink bởi _release_shared_capture.
+    """
+    blocks = {}
+    for key, frame_ref in capture.pop("frame_refs", {}).items():
+        name, shape, dtype = frame_ref
+        shm = shared_memory.SharedMemory(name=name)
+        blocks[key] = (shm, frame_ref)
+        capture[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    capture["shared_memory"] = blocks
+    return capture
+
+
+def _release_shared_capture(capture):
+    """Giải phóng các block shared memory của capture (nếu có)"""
+    if not capture:
+        return
+    blocks = capture.pop("shared_memory", None) or {}
+    for key in blocks:
+        capture[key] = None
+    for shm, _ in blocks.values():
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # Còn view numpy trỏ vào block: vùng nhớ được trả khi view bị thu hồi
+            pass
+
+
+def _recv_decode_message(conn, timeout):
+    """Chờ message từ worker decode tối đa timeout giây (None = chờ mãi); trả None nếu hết giờ"""
+    if not conn.poll(timeout):
+        return None
+    return conn.recv()
+
+
+class DecodeWorkerPool:
+    """
+    Pool process decode có watchdog: mỗi job chạy _extract_frame_sync trong một process riêng
+
+    Thread không thể bị huỷ khi cv2 treo trong open()/read() (CDN giữ kết nối mà không gửi dữ liệu),
+    còn process thì có thể kill. Process cha theo dõi bước hiện tại của worker qua pipe; bước nào
+    vượt deadline (hoặc cả job vượt video_timeout, hoặc coroutine bị huỷ) thì worker bị kill và một
+    worker mới được tạo thay thế khi cần, nên job kẹt không chiếm slot vĩnh viễn.
+
+    Worker được tạo bằng forkserver (spawn trên Windows): fork từ process server đơn luồng đã
+    import sẵn cv2/numpy, tránh fork process cha đang có nhiều thread.
+    """
+
+    READY_TIMEOUT = 120.0
+
+    def __init__(self, generator, size, stage_timeouts, video_timeout=None, wait_executor=None, on_kill=None):
+        """
+        Args:
+            generator (VideoThumbnailGenerator): Cấu hình được pickle sang worker
+            size (int): Số worker tối đa
+            stage_timeouts (dict): {stage: giây} - deadline từng bước (bước không có trong dict
+                chỉ bị giới hạn bởi video_timeout)
+            video_timeout (float): Deadline cho cả một job (None = không giới hạn)
+            wait_executor (Executor): Thread pool dùng để chờ pipe (None = executor mặc định của loop)
+            on_kill (callable): Gọi với dict thông tin mỗi khi một worker bị kill hoặc chết bất thường
+        """
+        self.generator = generator
+        self.size = size
+        self.stage_timeouts = stage_timeouts
+        self.video_timeout = video_timeout
+        self.wait_executor = wait_executor
+        self.on_kill = on_kill
+        self._context = _worker_mp_context()
+        self._idle = []
+        self._workers = set()
+        self._waiters = []
+        self.killed = 0
+
+    async def _spawn(self):
+        """Tạo worker mới và chờ nó sẵn sàng"""
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_decode_worker_main, args=(self.generator, child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        loop = asyncio.get_running_loop()
+        message = await loop.run_in_executor(self.wait_executor, _recv_decode_message, parent_conn, self.READY_TIMEOUT)
+        if message is None or message[0] != "ready":
+            process.kill()
+            raise RuntimeError("worker decode không khởi động được")
+        return process, parent_conn
+
+    async def _acquire(self):
+        """Lấy worker rảnh, tạo thêm nếu chưa đủ size, ngược lại chờ (FIFO)"""
+        while True:
+            if self._idle:
+                return self._idle.pop()
+            if len(self._workers) < self.size:
+                # Giữ chỗ trước khi await để các job khác không tạo vượt quá size
+                placeholder = object()
+                self._workers.add(placeholder)
+                try:
+                    worker = await self._spawn()
+                except BaseException:
+                    # Chỗ giữ được trả lại: đánh thức job đang chờ để nó thử tạo worker thay vì chờ mãi
+                    self._workers.discard(placeholder)
+                    self._wake()
+                    raise
+                self._workers.discard(placeholder)
+                self._workers.add(worker)
+                return worker
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            await future
+
+    def _release(self, worker):
+        self._idle.append(worker)
+        self._wake()
+
+    def _discard(self, worker, reason, video_url, stage):
+        """Kill worker (không chờ nó tự thoát) và nhường chỗ cho worker mới"""
+        process, _ = worker
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=1)
+        # Không đóng pipe ở đây: thread đang poll (nếu có) sẽ nhận EOF và tự trả pipe cho GC
+        self._workers.discard(worker)
+        self.killed += 1
+        info = {"time": datetime.now().isoformat(timespec='seconds'), "reason": reason,
+                "stage": stage, "url": video_url, "pid": process.pid}
+        print(f"🔪 Kill worker decode {process.pid} ({reason}, bước {stage}): {video_url}")
+        if self.on_kill is not None:
+            self.on_kill(info)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            future = self._waiters.pop(0)
+            if not future.done():
+                future.set_result(None)
+                break
+
+    async def extract(self, video_url, timestamp):
+        """
+        Chạy _extract_frame_sync trong worker có giám sát
+
+        Returns:
+            dict: capture như _extract_frame_sync (frame nằm trong shared memory, người gọi giải phóng
+            bằng _release_shared_capture) hoặc None nếu lỗi/worker chết
+
+        Raises:
+            DecodeTimeoutError: Một bước hoặc cả job vượt deadline (worker đã bị kill)
+        """
+        worker = await self._acquire()
+        process, conn = worker
+        loop = asyncio.get_running_loop()
+        clean = False
+        stage = "queued"
+        try:
+            conn.send((video_url, timestamp))
+            started = stage_started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                limits = []
+                if self.stage_timeouts.get(stage):
+                    limits.append((stage_started + self.stage_timeouts[stage] - now, stage, self.stage_timeouts[stage]))
+                if self.video_timeout:
+                    limits.append((started + self.video_timeout - now, "video", self.video_timeout))
+                deadline = min(limits) if limits else None
+                wait = max(0.0, deadline[0]) if deadline else None
+                try:
+                    message = await loop.run_in_executor(self.wait_executor, _recv_decode_message, conn, wait)
+                except (EOFError, OSError):
+                    self._discard(worker, "crash", video_url, stage)
+                    worker = None
+                    return None
+                if message is None:
+                    self._discard(worker, "timeout", video_url, stage)
+                    worker = None
+                    raise DecodeTimeoutError(deadline[1], deadline[2])
+                kind, payload = message
+                if kind == "stage":
+                    stage, stage_started = payload, time.monotonic()
+                elif kind == "timeout":
+                    clean = True
+                    raise DecodeTimeoutError(*payload)
+                else:
+                    clean = True
+                    return _attach_shared_capture(payload) if payload is not None else None
+        finally:
+            if worker is not None:
+                if clean:
+                    self._release(worker)
+                else:
+                    # Bị huỷ giữa chừng (vd: Ctrl+C): không biết worker đang ở trạng thái nào
+                    self._discard(worker, "cancelled", video_url, stage)
+
+    def close(self):
+        """Dừng tất cả worker"""
+        for worker in list(self._workers):
+            if not isinstance(worker, tuple):
+                continue
+            process, conn = worker
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            process.join(timeout=2)
+            if process.is_alive():
+                process.kill()
+                process.join(timeout=1)
+            conn.close()
+        self._workers.clear()
+        self._idle.clear()
+
+
+def _sampled_profile(kind):
+    """
+    Decorator: chạy cProfile cho một phần các lần gọi (theo profile_sample_rate của generator)
+    và ghi file .prof vào profile_dir (hoạt động cả trong thread I/O lẫn process con)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.profile_sample_rate or random.random() >= self.profile_sample_rate:
+                return method(self, *args, **kwargs)
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(method, self, *args, **kwargs)
+            finally:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{kind}_{os.getpid()}_{time.time_ns()}.prof"))
+        return wrapper
+    return decorator
+
+
+def _parse_mp4_box_header(data, pos=0):
+    """
+    Đọc header của một box MP4 tại vị trí pos
+
+    Returns:
+        tuple: (box_type, header_size, box_size) - box_size None nếu box kéo dài tới hết file,
+        hoặc None nếu không đủ dữ liệu
+    """
+    if len(data) - pos < 8:
+        return None
+    size, box_type = struct.unpack('>I4s', data[pos:pos + 8])
+    header_size = 8
+    if size == 1:
+        if len(data) - pos < 16:
+            return None
+        size = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+        header_size = 16
+    elif size == 0:
+        size = None
+    return box_type.decode('latin-1'), header_size, size
+
+
+def _parse_mp4_duration(moov):
+    """Lấy thời lượng video (giây) từ box mvhd bên trong moov, None nếu không đọc được"""
+    pos = 8
+    while pos < len(moov):
+        header = _parse_mp4_box_header(moov, pos)
+        if header is None:
+            return None
+        box_type, header_size, size = header
+        if box_type == 'mvhd':
+            body = moov[pos + header_size:]
+            version = body[0] if body else 0
+            if version == 1 and len(body) >= 32:
+                timescale, duration = struct.unpack('>IQ', body[20:32])
+            elif len(body) >= 20:
+                timescale, duration = struct.unpack('>II', body[12:20])
+            else:
+                return None
+            return duration / timescale if timescale else None
+        if not size:
+            return None
+        pos += size
+    return None
+
+
+def _partial_video_dir():
+    """Thư mục chứa file video tạm: ưu tiên /dev/shm (tmpfs, nằm trong RAM)"""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _atomic_write(path, data):
+    """Ghi data ra file tạm cùng thư mục rồi rename: không bao giờ để lại file (ảnh, JSON, CSV) ghi dở"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ThumbnailEncoder(abc.ABC):
+    """
+    Encoder ảnh thumbnail (JPEG/WebP/AVIF) - lớp cơ sở của các backend trong ENCODER_BACKENDS
+
+    Args:
+        image_format (str): "jpeg", "webp" hoặc "avif"
+        quality (int): Chất lượng nén (1-100)
+        effort (int): Mức công sức nén 0 (nhanh nhất) - 6 (nhỏ nhất); WebP dùng làm method,
+            AVIF quy đổi sang speed (10 - effort * 10 / 6)
+    """
+    EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp", "avif": ".avif"}
+
+    def __init__(self, image_format="jpeg", quality=85, effort=4):
+        if image_format not in self.EXTENSIONS:
+            raise ValueError("image_format phải là 'jpeg', 'webp' hoặc 'avif'")
+        if not self.supports(image_format):
+            raise ValueError(f"Encoder {type(self).__name__} không hỗ trợ định dạng {image_format} trên máy này")
+        self.image_format = image_format
+        self.quality = quality
+        self.effort = effort
+
+    @property
+    def extension(self):
+        return self.EXTENSIONS[self.image_format]
+
+    @property
+    def avif_speed(self):
+        return max(0, min(10, round(10 - self.effort * 10 / 6)))
+
+    @classmethod
+    def supports(cls, image_format):
+        return True
+
+    @abc.abstractmethod
+    def encode(self, bgr):
+        """Encode ảnh BGR (numpy) thành bytes"""
+
+    def encode_pil(self, image):
+        """Encode ảnh PIL RGB thành bytes"""
+        return self.encode(cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR))
+
+
+class Cv2Encoder(ThumbnailEncoder):
+    """Encode thẳng từ buffer BGR bằng cv2.imencode (không cvtColor, không copy sang PIL)"""
+
+    @classmethod
+    def supports(cls, image_format):
+        return cv2.haveImageWriter("x" + cls.EXTENSIONS[image_format])
+
+    def encode(self, bgr):
+        if self.image_format == "jpeg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        elif self.image_format == "webp":
+            # cv2 không có tham số method cho WebP nên effort không áp dụng
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        else:
+            params = [cv2.IMWRITE_AVIF_QUALITY, self.quality, cv2.IMWRITE_AVIF_SPEED, self.avif_speed]
+        ok, encoded = cv2.imencode(self.extension, bgr, params)
+        if not ok:
+            raise RuntimeError(f"cv2.imencode không encode được {self.image_format}")
+        return encoded.tobytes()
+
+
+class PilEncoder(ThumbnailEncoder):
+    """Encode bằng Pillow (cần chuyển BGR -> RGB; dùng được method của WebP)"""
+
+    @classmethod
+    def supports(cls, image_format):
+        return image_format == "jpeg" or bool(features.check(image_format))
+
+    def encode(self, bgr):
+        return self.encode_pil(Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)))
+
+    def encode_pil(self, image):
+        buffer = io.BytesIO()
+        if self.image_format == "jpeg":
+            image.save(buffer, 'JPEG', quality=self.quality)
+        elif self.image_format == "webp":
+            image.save(buffer, 'WEBP', quality=self.quality, method=self.effort)
+        else:
+            image.save(buffer, 'AVIF', quality=self.quality, speed=self.avif_speed)
+        return buffer.getvalue()
+
+
+# Các backend encoder có thể chọn qua tham số encoder_backend (đăng ký thêm backend mới tại đây)
+ENCODER_BACKENDS = {"cv2": Cv2Encoder, "pil": PilEncoder}
+
+
+def create_encoder(backend="cv2", image_format="jpeg", quality=85, effort=4):
+    """Tạo encoder theo tên backend trong ENCODER_BACKENDS"""
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"encoder_backend phải là một trong {sorted(ENCODER_BACKENDS)}")
+    return ENCODER_BACKENDS[backend](image_format, quality, effort)
+
+
+class ThumbnailStore:
+    """
+    Nơi lưu thumbnail: đặt tên file, đường dẫn web và kiểm tra file đã có
+
+    layout="hashed": tên file là sha1(url + fingerprint cấu hình) nên ổn định giữa các lần chạy và
+    giữa các process (cache trình duyệt/CDN vẫn đúng sau khi build lại, đổi cấu hình thì đổi tên),
+    không bao giờ trùng nên không cần dò os.path.exists. File được chia vào hai cấp thư mục con
+    theo 4 ký tự hex đầu (<root>/ab/cd/abcd....jpg) để không thư mục nào chứa hàng chục nghìn file.
+    Danh sách file đã có được đọc một lần bằng os.scandir vào bộ nhớ, kiểm tra tồn tại là O(1).
+
+    layout="flat": kiểu cũ, tên theo title + timestamp trong một thư mục, trùng tên thì thêm _1, _2, ...
+    """
+
+    LAYOUTS = ("flat", "hashed")
+
+    def __init__(self, root, web_prefix, fingerprint, layout="flat"):
+        if layout not in self.LAYOUTS:
+            raise ValueError("storage_layout phải là 'flat' hoặc 'hashed'")
+        self.root = root
+        self.web_prefix = web_prefix
+        self.fingerprint = fingerprint
+        self.layout = layout
+        self._files = None
+        self._dirs = set()
+
+    def __getstate__(self):
+        # Index file chỉ dùng ở process cha, không pickle sang process con
+        state = self.__dict__.copy()
+        state['_files'] = None
+        state['_dirs'] = set()
+        return state
+
+    def key(self, url):
+        """Khoá ổn định của URL với cấu hình hiện tại (không dùng hash() vì có random seed theo process)"""
+        return hashlib.sha1(f"{url}\n{self.fingerprint}".encode('utf-8')).hexdigest()[:20]
+
+    def path_for(self, url, ext, name=None):
+        """
+        Đường dẫn file thumbnail cho URL (tạo thư mục con nếu cần)
+
+        Args:
+            url (str): URL nguồn
+            ext (str): Đuôi file (vd: ".jpg")
+            name (str): Tên theo title cho layout flat (None = dùng khoá của URL)
+        """
+        if self.layout == "hashed":
+            key = self.key(url)
+            directory = os.path.join(self.root, key[:2], key[2:4])
+            if directory not in self._dirs:
+                os.makedirs(directory, exist_ok=True)
+                self._dirs.add(directory)
+            return os.path.join(directory, key + ext)
+        return self._unique_path(os.path.join(self.root, f"{name or 'video_' + self.key(url)[:12]}{ext}"))
+
+    @staticmethod
+    def _unique_path(filepath):
+        """Đảm bảo tên file unique nếu đã tồn tại (thêm hậu tố _1, _2, ...)"""
+        counter = 1
+        original_filepath = filepath
+        while os.path.exists(filepath):
+            name, ext = os.path.splitext(original_filepath)
+            filepath = f"{name}_{counter}{ext}"
+            counter += 1
+        return filepath
+
+    def web_path(self, path):
+        """Đường dẫn web của file trong store (giữ các thư mục con của layout hashed)"""
+        return self.web_prefix + os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def load_index(self):
+        """Đọc danh sách file đã có trong hai cấp thư mục con (một lượt os.scandir)"""
+        self._files = set()
+        if self.layout != "hashed" or not os.path.isdir(self.root):
+            return
+        for first in os.scandir(self.root):
+            if not (first.is_dir() and len(first.name) == 2):
+                continue
+            for second in os.scandir(first.path):
+                if not (second.is_dir() and len(second.name) == 2):
+                    continue
+                self._dirs.add(second.path)
+                self._files.update(os.path.join(second.path, entry.name) for entry in os.scandir(second.path))
+        print(f"🗄️ Thumbnail store: {len(self._files)} file trong {len(self._dirs)} thư mục con ({self.root})")
+
+    def add(self, *paths):
+        """Ghi nhận file vừa được ghi (gọi ở process cha khi job xong)"""
+        if self._files is not None:
+            self._files.update(path for path in paths if path)
+
+    def exists(self, path):
+        """
+        Kiểm tra file còn tồn tại: O(1) trong bộ nhớ với file thuộc layout hashed,
+        các đường dẫn khác (thumbnail kiểu cũ, vd: từ manifest) vẫn hỏi filesystem
+        """
+        if not path:
+            return False
+        if self._files is not None and self.layout == "hashed":
+            normalized = os.path.normpath(path)
+            if os.path.dirname(os.path.dirname(os.path.dirname(normalized))) == os.path.normpath(self.root):
+                return normalized in self._files
+        return os.path.exists(path)
+
+
+class ThumbnailManifest:
+    """
+    Manifest lưu trạng thái thumbnail theo URL, dùng cho chế độ incremental/resume
+
+    Mỗi entry gồm: thumbnail_path, web_path, fingerprint (cấu hình tạo thumbnail),
+    status, error và thời điểm cập nhật. Chỉ những URL mới, lỗi, mất file
+    hoặc khác fingerprint mới cần xử lý lại.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """Đọc manifest từ file (nếu có)"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('entries', {})
+            print(f"📒 Đã đọc manifest: {self.path} ({len(self.entries)} URL)")
+        except Exception as e:
+            print(f"⚠️ Không đọc được manifest {self.path}, bắt đầu lại từ đầu: {str(e)}")
+            self.entries = {}
+
+    def save(self):
+        """Ghi manifest ra file tạm rồi rename để tránh hỏng file khi bị ngắt giữa chừng"""
+        _atomic_write(self.path, json.dumps({'version': 1, 'entries': self.entries}, ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def resolve_path(path):
+        """Chuẩn hoá đường dẫn (vid.csv cũ có thể chứa dấu '\\' của Windows)"""
+        return path.replace('\\', os.sep).replace('/', os.sep) if path else path
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def needs_processing(self, url, fingerprint, exists=os.path.exists, required_columns=()):
+        """
+        Kiểm tra URL có cần tạo lại thumbnail hay không
+
+        Args:
+            exists (callable): Hàm kiểm tra file tồn tại (vd: ThumbnailStore.exists, không stat đĩa)
+            required_columns (tuple): Các cột bổ sung entry phải có (vd: lqip, source_width);
+                entry tạo từ phiên bản cũ chưa ghi các cột này sẽ được xử lý lại
+
+        Returns:
+            bool: True nếu URL mới, lần trước lỗi, file không còn trên đĩa, cấu hình đã đổi hoặc thiếu cột
+        """
+        entry = self.entries.get(url)
+        if entry is None or entry.get('status') != 'success':
+            return True
+        if entry.get('fingerprint') != fingerprint:
+            return True
+        columns = entry.get('columns', {})
+        if any(column not in columns for column in required_columns):
+            return True
+        return not exists(self.resolve_path(entry.get('thumbnail_path')))
+
+    def update(self, url, result, fingerprint, columns=None):
+        """
+        Cập nhật entry từ kết quả của create_thumbnail_async
+
+        Args:
+            columns (dict): Các cột bổ sung của kết quả (sprite, ...) để dựng lại dòng CSV khi bỏ qua
+        """
+        self.entries[url] = {
+            'thumbnail_path': result.get('thumbnail_path') or '',
+            'web_path': result.get('web_path') or '',
+            'columns': columns or {},
+            'fingerprint': fingerprint,
+            'status': 'success' if result.get('success') else 'failed',
+            'error': result.get('error') or '',
+            'updated_at': int(time.time()),
+        }
+
+    def replay_journal(self, journal_path):
+        """
+        Áp dụng các kết quả trong journal của lần chạy bị ngắt vào manifest
+
+        Returns:
+            int: Số record đã áp dụng
+        """
+        replayed = 0
+        for record in ResultsJournal.read(journal_path):
+            row = record.get('row', {})
+            if not row.get('url') or 'fingerprint' not in record:
+                continue
+            self.entries[row['url']] = {
+                'thumbnail_path': row.get('thumbnail_path') or '',
+                'web_path': row.get('web_path') or '',
+                'columns': record.get('columns') or {},
+                'fingerprint': record['fingerprint'],
+                'status': row.get('status', 'failed'),
+                'error': row.get('error') or '',
+                'updated_at': int(time.time()),
+            }
+            replayed += 1
+        if replayed:
+            print(f"📒 Đã khôi phục {replayed} kết quả từ journal {journal_path}")
+        return replayed
+
+    def seed_from_csv(self, csv_path, fingerprint, include=None, columns=()):
+        """
+        Khởi tạo manifest từ vid.csv của lần chạy trước (các dòng success còn file trên đĩa)
+
+        Args:
+            csv_path (str): Đường dẫn vid.csv cũ
+            fingerprint (str): Fingerprint gán cho các entry (giả định cùng cấu hình hiện tại)
+            include (callable): Chỉ nhập URL mà include(url) là True (vd: URL thuộc shard hiện tại)
+            columns (tuple): Các cột bổ sung (RESULT_COLUMNS) chép từ CSV vào entry để dựng lại dòng
+                khi bỏ qua và để needs_processing không coi entry là thiếu cột (ô trống = không có)
+
+        Returns:
+            int: Số entry đã nhập
+        """
+        if not os.path.exists(csv_path):
+            return 0
+        df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+        seeded = 0
+        for row in df.to_dict('records'):
+            url = row.get('url')
+            if not url or url in self.entries or row.get('status') != 'success':
+                continue
+            if include is not None and not include(url):
+                continue
+            if not os.path.exists(self.resolve_path(row.get('thumbnail_path'))):
+                continue
+            self.entries[url] = {
+                'thumbnail_path': row.get('thumbnail_path', ''),
+                'web_path': row.get('web_path', ''),
+                'columns': {column: row[column] for column in columns if row.get(column, '') != ''},
+                'fingerprint': fingerprint,
+                'status': 'success',
+                'error': '',
+                'updated_at': int(time.time()),
+            }
+            seeded += 1
+        print(f"📒 Đã nhập {seeded} thumbnail có sẵn từ {csv_path} vào manifest")
+        return seeded
+
+
+class ResultsJournal:
+    """
+    Journal kết quả dạng JSON Lines, chỉ ghi nối (append-only)
+
+    Mỗi dòng là một record {"idx", "row", "fingerprint", "columns"} ghi ngay khi job xong.
+    fsync theo lô (mỗi fsync_every record hoặc fsync_interval giây) để hạn chế I/O.
+    Cuối lần chạy journal được compact một lần thành CSV có thứ tự; nếu bị ngắt,
+    journal còn lại được dùng làm checkpoint để resume.
+    """
+
+    def __init__(self, path, fsync_every=64, fsync_interval=2.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def open(self, truncate=False):
+        """Mở journal để ghi (truncate=True để bắt đầu journal mới)"""
+        self._file = open(self.path, 'w' if truncate else 'a', encoding='utf-8')
+        self._last_sync = time.monotonic()
+
+    def append(self, record):
+        """Ghi nối một record"""
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self._pending += 1
+        if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Flush và fsync các record đang chờ"""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def read(path):
+        """Đọc các record của journal (bỏ qua dòng cuối bị ghi dở khi crash)"""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def load_rows(self):
+        """
+        Compact journal: lấy record mới nhất của mỗi idx, sắp xếp theo thứ tự input
+
+        Returns:
+            pandas.DataFrame: Các dòng kết quả
+        """
+        self.sync()
+        rows = {}
+        for record in self.read(self.path):
+            rows[record['idx']] = record['row']
+        return pd.DataFrame([rows[idx] for idx in sorted(rows)], dtype=object)
+
+
+class PerceptualHashIndex:
+    """
+    Index perceptual hash (dHash 64-bit) của các thumbnail đã tạo, dùng để phát hiện video trùng
+
+    Tra cứu lân cận theo khoảng cách Hamming bằng BK-tree (không phải so với toàn bộ index).
+    Hash của một frame 9x8 dễ trùng giữa các clip khác nhau (cùng bố cục, frame tối), nên bản khớp
+    còn phải có cùng thời lượng và tỷ lệ khung hình (trong sai số) mới được coi là video trùng.
+    Index được lưu ra JSON kèm fingerprint cấu hình; khác fingerprint thì bắt đầu index mới
+    (thumbnail cũ không còn dùng lại được).
+    """
+
+    # Sai số cho phép: thời lượng max(giây, tỷ lệ), tỷ lệ khung hình tương đối
+    DURATION_TOLERANCE = (0.5, 0.02)
+    ASPECT_TOLERANCE = 0.02
+
+    def __init__(self, path, fingerprint, max_distance=6):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_distance = max_distance
+        self.entries = {}
+        # Node BK-tree: [hash, {khoảng cách: node con}]
+        self._root = None
+        # Hash của các video đang encode: {hash: asyncio.Future}, để bản trùng đang chạy song song chờ bản gốc
+        self._pending = {}
+        self.load()
+
+    @staticmethod
+    def dhash(frame):
+        """
+        dHash 64-bit của frame BGR: thu nhỏ 9x8 grayscale, so sánh từng cặp pixel kề nhau theo hàng
+
+        Returns:
+            int: Hash 64-bit
+        """
+        gray = cv2.cvtColor(cv2.resize(frame, (9, 8), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    @staticmethod
+    def distance(a, b):
+        return (a ^ b).bit_count()
+
+    @staticmethod
+    def _as_float(value):
+        try:
+            return float(value) if value not in (None, '') else None
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def compatible(cls, entry, duration=None, aspect_ratio=None):
+        """Entry có cùng thời lượng và tỷ lệ khung hình (trong sai số) với video đang xét không"""
+        columns = entry.get('columns', {})
+        duration, other_duration = cls._as_float(duration), cls._as_float(columns.get('duration'))
+        # Một bên không biết thời lượng (vd: livestream) còn bên kia biết: không phải cùng một clip
+        if (duration is None) != (other_duration is None):
+            return False
+        if duration is not None and abs(duration - other_duration) > max(
+                cls.DURATION_TOLERANCE[0], cls.DURATION_TOLERANCE[1] * max(duration, other_duration)):
+            return False
+        aspect_ratio, other_aspect = cls._as_float(aspect_ratio), cls._as_float(columns.get('aspect_ratio'))
+        if aspect_ratio and other_aspect and abs(aspect_ratio - other_aspect) > cls.ASPECT_TOLERANCE * aspect_ratio:
+            return False
+        return True
+
+    def load(self):
+        """Đọc index từ file (bỏ qua nếu khác fingerprint)"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Không đọc được hash index {self.path}, bắt đầu lại từ đầu: {str(e)}")
+            return
+        if data.get('fingerprint') != self.fingerprint:
+            print(f"📒 Hash index {self.path} thuộc cấu hình khác, bắt đầu index mới")
+            return
+        for key, entry in data.get('entries', {}).items():
+            self._insert(int(key, 16), entry)
+        print(f"📒 Đã đọc hash index: {self.path} ({len(self.entries)} thumbnail)")
+
+    def save(self):
+        """Ghi index ra file tạm rồi rename"""
+        data = {'version': 1, 'fingerprint': self.fingerprint,
+                'entries': {f"{h:016x}": entry for h, entry in self.entries.items()}}
+        _atomic_write(self.path, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def _insert(self, phash, entry):
+        if phash in self.entries:
+            self.entries[phash] = entry
+            return
+        self.entries[phash] = entry
+        if self._root is None:
+            self._root = [phash, {}]
+            return
+        node = self._root
+        while True:
+            d = self.distance(phash, node[0])
+            child = node[1].get(d)
+            if child is None:
+                node[1][d] = [phash, {}]
+                return
+            node = child
+
+    def find(self, phash, duration=None, aspect_ratio=None):
+        """
+        Tìm thumbnail gần nhất trong phạm vi max_distance (file phải còn trên đĩa,
+        cùng thời lượng và tỷ lệ khung hình theo compatible)
+
+        Returns:
+            tuple: (distance, entry) hoặc None
+        """
+        best = None
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            d = self.distance(phash, node[0])
+            if d <= self.max_distance and (best is None or d < best[0]):
+                entry = self.entries[node[0]]
+                if self.compatible(entry, duration, aspect_ratio) and os.path.exists(ThumbnailManifest.resolve_path(entry.get('thumbnail_path'))):
+                    best = (d, entry)
+            # Bất đẳng thức tam giác: chỉ các nhánh có khoảng cách trong [d - r, d + r] mới có thể khớp
+            for child_distance, child in node[1].items():
+                if d - self.max_distance <= child_distance <= d + self.max_distance:
+                    stack.append(child)
+        return best
+
+    def add(self, phash, url, result, columns=None):
+        """Thêm thumbnail vừa tạo vào index"""
+        self._insert(phash, {
+            'url': url,
+            'thumbnail_path': result.get('thumbnail_path') or '',
+            'web_path': result.get('web_path') or '',
+            'columns': columns or {},
+        })
+
+    async def wait_pending(self, phash):
+        """Chờ các video đang encode có hash gần phash (nếu có) xử lý xong"""
+        waiting = [future for other, future in self._pending.items() if self.distance(phash, other) <= self.max_distance]
+        if waiting:
+            await asyncio.wait(waiting)
+        return bool(waiting)
+
+    def reserve(self, phash):
+        """Đánh dấu hash đang được encode (giữ tới khi release)"""
+        self._pending.setdefault(phash, asyncio.get_event_loop().create_future())
+
+    def release(self, phash):
+        future = self._pending.pop(phash, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+
+class StageTimer:
+    """Đo thời gian các stage liên tiếp: mark(stage) cộng thời gian kể từ lần mark trước vào stage"""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+
+class StageMetrics:
+    """
+    Thống kê của một lần chạy: histogram thời gian từng stage, số byte, số lỗi theo loại và host
+
+    Chỉ sống ở process cha (event loop); thời gian đo trong thread I/O và process con được
+    trả về cùng kết quả rồi mới ghi vào đây. Xuất ra JSON (kèm percentile) và file text
+    định dạng Prometheus (node_exporter textfile collector đọc được).
+    """
+
+    # Upper bound (giây) của các bucket histogram
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    # Số mẫu tối đa giữ lại cho mỗi stage để tính percentile (reservoir sampling)
+    RESERVOIR_SIZE = 4096
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = {}
+        self.bytes = {}
+        self.errors = {}
+        self.jobs = {}
+        self.gauges = {}
+        self.events = {}
+
+    def observe(self, stage, seconds):
+        """Ghi nhận thời gian của một stage"""
+        state = self.stages.get(stage)
+        if state is None:
+            state = self.stages[stage] = {"buckets": [0] * (len(self.BUCKETS) + 1), "sum": 0.0,
+                                          "count": 0, "max": 0.0, "samples": []}
+        index = next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))
+        state["buckets"][index] += 1
+        state["sum"] += seconds
+        state["count"] += 1
+        state["max"] = max(state["max"], seconds)
+        samples = state["samples"]
+        if len(samples) < self.RESERVOIR_SIZE:
+            samples.append(seconds)
+        else:
+            slot = random.randrange(state["count"])
+            if slot < self.RESERVOIR_SIZE:
+                samples[slot] = seconds
+
+    def observe_all(self, timings):
+        for stage, seconds in (timings or {}).items():
+            self.observe(stage, seconds)
+
+    def add_bytes(self, kind, count):
+        self.bytes[kind] = self.bytes.get(kind, 0) + count
+
+    def record_error(self, category, host=""):
+        key = (category, host or "local")
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def record_job(self, status):
+        self.jobs[status] = self.jobs.get(status, 0) + 1
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def record_event(self, kind, data, keep=500):
+        """Lưu sự kiện (vd: các lần điều chỉnh concurrency), giữ keep sự kiện gần nhất"""
+        events = self.events.setdefault(kind, [])
+        events.append(data)
+        del events[:-keep]
+
+    def summary(self):
+        """Tổng hợp dạng dict (percentile tính từ reservoir)"""
+        stages = {}
+        for stage, state in sorted(self.stages.items()):
+            p50, p90, p95, p99 = (np.percentile(state["samples"], [50, 90, 95, 99]).tolist()
+                                  if state["samples"] else (0.0, 0.0, 0.0, 0.0))
+            stages[stage] = {
+                "count": state["count"],
+                "total_s": round(state["sum"], 4),
+                "mean_ms": round(state["sum"] / state["count"] * 1000, 3) if state["count"] else 0.0,
+                "p50_ms": round(p50 * 1000, 3),
+                "p90_ms": round(p90 * 1000, 3),
+                "p95_ms": round(p95 * 1000, 3),
+                "p99_ms": round(p99 * 1000, 3),
+                "max_ms": round(state["max"] * 1000, 3),
+            }
+        errors = {}
+        for (category, host), count in sorted(self.errors.items()):
+            errors.setdefault(category, {})[host] = count
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            "elapsed_s": round(time.time() - self.started_at, 3),
+            "jobs": dict(self.jobs),
+            "stages": stages,
+            "bytes": dict(self.bytes),
+            "errors": errors,
+            "gauges": dict(self.gauges),
+            "events": {kind: list(events) for kind, events in self.events.items()},
+        }
+
+    def to_prometheus(self):
+        """Xuất metrics dạng text exposition của Prometheus"""
+        lines = [
+            "# HELP thumb_stage_seconds Thời gian xử lý từng stage",
+            "# TYPE thumb_stage_seconds histogram",
+        ]
+        for stage, state in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), state["buckets"]):
+                cumulative += count
+                lines.append(f'thumb_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'thumb_stage_seconds_sum{{stage="{stage}"}} {state["sum"]:.6f}')
+            lines.append(f'thumb_stage_seconds_count{{stage="{stage}"}} {state["count"]}')
+        lines += ["# HELP thumb_bytes_total Số byte đã tải/ghi", "# TYPE thumb_bytes_total counter"]
+        lines += [f'thumb_bytes_total{{kind="{kind}"}} {count}' for kind, count in sorted(self.bytes.items())]
+        lines += ["# HELP thumb_errors_total Số lỗi theo loại và host", "# TYPE thumb_errors_total counter"]
+        lines += [f'thumb_errors_total{{category="{category}",host="{host}"}} {count}'
+                  for (category, host), count in sorted(self.errors.items())]
+        lines += ["# HELP thumb_jobs_total Số video theo trạng thái", "# TYPE thumb_jobs_total counter"]
+        lines += [f'thumb_jobs_total{{status="{status}"}} {count}' for status, count in sorted(self.jobs.items())]
+        for name, value in sorted(self.gauges.items()):
+            lines += [f"# TYPE thumb_{name} gauge", f"thumb_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path, prom_path=None):
+        """Ghi JSON summary (và file Prometheus) bằng file tạm + rename"""
+        for path, content in ((json_path, json.dumps(self.summary(), ensure_ascii=False, indent=2)),
+                              (prom_path, self.to_prometheus() if prom_path else None)):
+            if not path:
+                continue
+            _atomic_write(path, content.encode('utf-8'))
+
+
+class GalleryIndexBuilder:
+    """
+    Index gallery dạng phân trang cho VideoGallery.js thay cho việc tải toàn bộ vid.csv
+
+    Gồm manifest.json nhỏ (tổng số video, kích thước shard, danh sách field, URL các shard) và
+    các shard JSON gọn (mỗi dòng là một mảng giá trị theo thứ tự field, chỉ giữ các cột UI dùng).
+    Tên shard chứa hash nội dung (page-00000.<sha>.json) nên shard không đổi giữ nguyên tên/file
+    giữa các lần chạy và có thể cache vĩnh viễn; chỉ shard thay đổi mới được ghi và nén lại.
+    Mỗi shard có kèm bản nén sẵn .gz (và .br nếu cài brotli) cho server dùng gzip_static/brotli_static.
+    """
+
+    # Các cột UI cần; cột tùy chọn chỉ được đưa vào nếu có ít nhất một giá trị
+    REQUIRED_FIELDS = ('url', 'title', 'web_path')
+    OPTIONAL_FIELDS = ('srcset', 'sprite_web_path', 'sprite_grid', 'sprite_tile', 'sprite_frames',
+                       'is_duplicate', 'format', 'pack_url', 'pack_offset', 'pack_size', 'lqip',
+                       'aspect_ratio', 'duration')
+    BOOLEAN_FIELDS = ('is_duplicate',)
+
+    def __init__(self, index_dir, url_prefix, shard_size=500):
+        """
+        Args:
+            index_dir (str): Thư mục ghi manifest.json và các shard
+            url_prefix (str): Tiền tố URL của thư mục index phía web (vd: "/temporary/vid-index/")
+            shard_size (int): Số video mỗi shard (nên là bội số của số video mỗi trang trên UI)
+        """
+        self.index_dir = index_dir
+        self.url_prefix = url_prefix.rstrip('/') + '/'
+        self.shard_size = shard_size
+        self.manifest_path = os.path.join(index_dir, "manifest.json")
+
+    @classmethod
+    def _compact_value(cls, field, value):
+        """Chuẩn hoá giá trị của một ô (NaN/None -> "", cột boolean -> 0/1)"""
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return ""
+        if field in cls.BOOLEAN_FIELDS:
+            return 1 if value is True or str(value).lower() == 'true' else 0
+        return value if isinstance(value, str) else str(value)
+
+    @classmethod
+    def listed_records(cls, result_df):
+        """Các dòng hiển thị trên gallery (có url và title, giống bộ lọc phía UI), đúng thứ tự"""
+        return [row for row in result_df.to_dict('records')
+                if cls._compact_value('url', row.get('url')) and cls._compact_value('title', row.get('title'))]
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Không đọc được gallery manifest {self.manifest_path}: {str(e)}")
+            return {}
+
+    def _write_shard(self, name, data):
+        """Ghi shard và các bản nén sẵn (bỏ qua nếu file cùng hash đã tồn tại)"""
+        path = os.path.join(self.index_dir, name)
+        if os.path.exists(path):
+            return False
+        # mtime=0 để bản .gz cũng xác định theo nội dung
+        _atomic_write(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _atomic_write(path + '.br', brotli.compress(data, quality=11))
+        # Ghi file gốc sau cùng: file gốc tồn tại nghĩa là các bản nén đã đầy đủ
+        _atomic_write(path, data)
+        return True
+
+    def build(self, result_df):
+        """
+        Dựng index từ DataFrame kết quả (cùng cột với vid.csv)
+
+        Chỉ giữ các dòng có url và title (giống bộ lọc phía UI). Shard của manifest trước
+        vẫn được giữ lại để client đang dùng manifest cũ không bị 404; shard cũ hơn bị xoá.
+
+        Returns:
+            dict: Manifest vừa ghi
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        records = self.listed_records(result_df)
+        fields = list(self.REQUIRED_FIELDS) + [
+            field for field in self.OPTIONAL_FIELDS
+            if field in result_df.columns
+            and any(self._compact_value(field, row.get(field)) for row in records)
+        ]
+
+        previous = self._load_manifest()
+        shards = []
+        written = 0
+        for offset in range(0, len(records), self.shard_size):
+            rows = [[self._compact_value(field, row.get(field)) for field in fields]
+                    for row in records[offset:offset + self.shard_size]]
+            data = json.dumps({'offset': offset, 'fields': fields, 'rows': rows},
+                              ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            sha = hashlib.sha256(data).hexdigest()[:12]
+            name = f"page-{offset // self.shard_size:05d}.{sha}.json"
+            written += self._write_shard(name, data)
+            shards.append({'url': self.url_prefix + name, 'offset': offset, 'count': len(rows),
+                           'sha': sha, 'bytes': len(data)})
+
+        manifest = {
+            'version': 1,
+            'generated_at': int(time.time()),
+            'total': len(records),
+            'shard_size': self.shard_size,
+            'fields': fields,
+            'shards': shards,
+        }
+        _atomic_write(self.manifest_path, json.dumps(manifest, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+        # Dọn các shard không thuộc manifest hiện tại và manifest ngay trước đó
+        keep = {os.path.basename(shard['url']) for shard in shards + previous.get('shards', [])}
+        removed = 0
+        for entry in os.scandir(self.index_dir):
+            base = re.sub(r'\.(gz|br)$', '', entry.name)
+            if entry.name.startswith('page-') and base not in keep:
+                os.remove(entry.path)
+                removed += 1
+
+        print(f"🗂️ Gallery index: {len(records)} video, {len(shards)} shard "
+              f"({written} shard mới/đổi, {len(shards) - written} giữ nguyên, xoá {removed} file cũ) -> {self.manifest_path}")
+        return manifest
+
+
+class ThumbnailPackBuilder:
+    """
+    Gói thumbnail của mỗi trang gallery thành một file pack nhị phân để mỗi trang chỉ cần một request
+
+    Pack là các file thumbnail nối liền nhau; vị trí từng thumbnail được ghi vào kết quả (cột
+    pack_url, pack_offset, pack_size) và đi theo gallery index, client tải pack rồi cắt Blob.
+    Mỗi file thumbnail chỉ được đóng gói một lần: các dòng dùng chung thumbnail (video trùng, URL lặp)
+    trỏ cùng pack, offset và size.
+    Trạng thái (file nguồn, size, mtime, sha1 từng thumbnail) lưu ở packs.json cạnh các pack.
+    Trang có thành viên không đổi giữ nguyên pack (tên theo hash nội dung); trang thay đổi được
+    đóng gói lại, thành viên cũ được copy từ pack cũ qua mmap (kiểm tra sha1 trước khi dùng lại)
+    thay vì đọc lại file nguồn.
+    """
+
+    def __init__(self, pack_dir, url_prefix, page_size=20):
+        """
+        Args:
+            pack_dir (str): Thư mục ghi các pack và packs.json
+            url_prefix (str): Tiền tố URL của thư mục pack phía web (vd: "/temporary/vid-packs/")
+            page_size (int): Số video mỗi trang gallery (phải khớp videosPerPage của VideoGallery.js)
+        """
+        self.pack_dir = pack_dir
+        self.url_prefix = url_prefix.rstrip('/') + '/'
+        self.page_size = page_size
+        self.state_path = os.path.join(pack_dir, "packs.json")
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            return state.get('pages', {}) if state.get('page_size') == self.page_size else {}
+        except Exception as e:
+            print(f"⚠️ Không đọc được {self.state_path}, đóng gói lại toàn bộ: {str(e)}")
+            return {}
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _open_pack(path):
+        """Map pack vào bộ nhớ (chỉ đọc); None nếu không có file"""
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            yield None
+            return
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+    @staticmethod
+    def _member_slice(mapped, member):
+        """Bytes của một thành viên trong pack nếu còn nguyên vẹn (đúng sha1), ngược lại None"""
+        end = member['offset'] + member['size']
+        if mapped is None or end > len(mapped):
+            return None
+        with memoryview(mapped) as view:
+            data = view[member['offset']:end]
+            try:
+                if hashlib.sha1(data).hexdigest() != member['sha1']:
+                    return None
+                return bytes(data)
+            finally:
+                data.release()
+
+    def _is_intact(self, info):
+        """Pack của trang còn nguyên vẹn: đúng kích thước và sha1 từng thành viên (băm trên mmap)"""
+        with self._open_pack(os.path.join(self.pack_dir, info['file'])) as mapped:
+            return mapped is not None and len(mapped) == info['bytes'] and all(
+                self._member_slice(mapped, member) is not None for member in info['members'])
+
+    def verify(self):
+        """
+        Kiểm tra toàn vẹn tất cả pack theo packs.json
+
+        Returns:
+            list: Số thứ tự các trang có pack hỏng hoặc thiếu
+        """
+        return [int(page) for page, info in sorted(self._load_state().items(), key=lambda item: int(item[0]))
+                if not self._is_intact(info)]
+
+    def _pack_page(self, page, members, previous):
+        """
+        Đóng gói một trang, dùng lại bytes của các thành viên không đổi từ pack cũ
+
+        Returns:
+            dict: Thông tin trang cho packs.json ({"file", "bytes", "sha", "members"})
+        """
+        chunks = []
+        entries = []
+        offset = 0
+        reused = 0
+        old_members = {}
+        old_path = os.path.join(self.pack_dir, previous['file']) if previous else None
+        if previous:
+            old_members = {(m['path'], m['size'], m['mtime_ns']): m for m in previous['members']}
+        with self._open_pack(old_path) if old_path else contextlib.nullcontext() as mapped:
+            for path, stat in members:
+                key = (path, stat.st_size, stat.st_mtime_ns)
+                data = self._member_slice(mapped, old_members[key]) if key in old_members else None
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                else:
+                    reused += 1
+                chunks.append(data)
+                entries.append({'path': path, 'size': len(data), 'mtime_ns': stat.st_mtime_ns,
+                                'offset': offset, 'sha1': hashlib.sha1(data).hexdigest()})
+                offset += len(data)
+        content = b''.join(chunks)
+        sha = hashlib.sha256(content).hexdigest()[:12]
+        name = f"page-{page:05d}.{sha}.pack"
+        # Luôn ghi lại (atomic): file cùng tên có thể chính là pack hỏng cần thay
+        _atomic_write(os.path.join(self.pack_dir, name), content)
+        return {'file': name, 'bytes': len(content), 'sha': sha, 'members': entries, 'reused': reused}
+
+    def build(self, result_df):
+        """
+        Đóng gói thumbnail theo trang gallery và gắn vị trí vào kết quả
+
+        Trang được chia trên cùng danh sách với GalleryIndexBuilder (dòng có url và title),
+        mỗi page_size dòng một trang; dòng lỗi vẫn chiếm chỗ trong trang nhưng không có trong pack.
+
+        Returns:
+            pandas.DataFrame: Bản sao result_df có thêm cột pack_url, pack_offset, pack_size
+        """
+        os.makedirs(self.pack_dir, exist_ok=True)
+        previous_pages = self._load_state()
+        records = GalleryIndexBuilder.listed_records(result_df)
+        pages = {}
+        # Vị trí theo đường dẫn thumbnail (không theo URL) để thumbnail dùng chung chỉ nằm trong pack một lần
+        locations = {}
+        row_paths = {}
+        kept = rebuilt = reused = 0
+        for page, start in enumerate(range(0, len(records), self.page_size)):
+            members = []
+            page_paths = set()
+            for row in records[start:start + self.page_size]:
+                path = ThumbnailManifest.resolve_path(row.get('thumbnail_path'))
+                if row.get('status') != 'success' or not path:
+                    continue
+                row_paths.setdefault(row['url'], path)
+                if path in locations or path in page_paths:
+                    continue
+                try:
+                    members.append((path, os.stat(path)))
+                except OSError:
+                    continue
+                page_paths.add(path)
+            if not members:
+                continue
+            previous = previous_pages.get(str(page))
+            signature = [(path, stat.st_size, stat.st_mtime_ns) for path, stat in members]
+            if previous and signature == [(m['path'], m['size'], m['mtime_ns']) for m in previous['members']] \
+                    and self._is_intact(previous):
+                info = previous
+                kept += 1
+            else:
+                info = self._pack_page(page, members, previous)
+                reused += info.pop('reused')
+                rebuilt += 1
+            pages[str(page)] = info
+            for member in info['members']:
+                locations[member['path']] = (self.url_prefix + info['file'], member['offset'], member['size'])
+
+        state = {'version': 1, 'page_size': self.page_size, 'generated_at': int(time.time()), 'pages': pages}
+        _atomic_write(self.state_path, json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+        # Giữ pack của lần build trước để client đang dùng index cũ không bị 404
+        keep = {info['file'] for info in list(pages.values()) + list(previous_pages.values())}
+        removed = 0
+        for entry in os.scandir(self.pack_dir):
+            if entry.name.endswith('.pack') and entry.name not in keep:
+                os.remove(entry.path)
+                removed += 1
+
+        result_df = result_df.copy()
+        row_locations = {url: locations[path] for url, path in row_paths.items() if path in locations}
+        for column, position in (('pack_url', 0), ('pack_offset', 1), ('pack_size', 2)):
+            result_df[column] = [row_locations[url][position] if url in row_locations else ''
+                                 for url in result_df['url']]
+        print(f"📦 Thumbnail pack: {len(pages)} trang ({rebuilt} đóng gói lại, {kept} giữ nguyên, "
+              f"{reused} thumbnail dùng lại từ pack cũ, xoá {removed} pack cũ) -> {self.pack_dir}")
+        return result_df
+
+
 class VideoThumbnailGenerator:
-    def __init__(self, output_dir="public/thumbnails", thumbnail_size=(320, 240), concurrent_limit=20, web_path_prefix="/temporary/thumbnails/"):
+    # Các cột bổ sung lấy từ kết quả của _process_frame_sync (chỉ ghi khi tính năng tương ứng được bật)
+    RESULT_COLUMNS = ('sprite_path', 'sprite_web_path', 'sprite_grid', 'sprite_tile', 'sprite_frames',
+                      'srcset', 'rendition_paths', 'frame_time', 'frame_score', 'phash', 'is_duplicate', 'duplicate_of',
+                      'format', 'source_width', 'source_height', 'aspect_ratio', 'lqip', 'duration', 'fps',
+                      'frame_count')
+    
+    # Các cột mô tả thumbnail (không phải video nguồn): video trùng được dùng lại từ video gốc
+    REUSABLE_COLUMNS = ('sprite_path', 'sprite_web_path', 'sprite_grid', 'sprite_tile', 'sprite_frames',
+                        'srcset', 'rendition_paths', 'format', 'lqip')
+    
+    # Các thuộc tính chỉ tồn tại ở process cha (không pickle sang process con)
+    _PARENT_ONLY_ATTRS = ('semaphore', 'cpu_semaphore', '_io_executor', '_cpu_executor', '_http_session', 'host_limiter',
+                         'phash_index', 'metrics', '_decode_pool')
+    
+    # Chỉ được gán trong worker decode có giám sát (báo bước đang chạy cho watchdog)
+    _stage_callback = None
+    
+    def __init__(self, output_dir="public/thumbnails", thumbnail_size=(320, 240), concurrent_limit=20, web_path_prefix="/temporary/thumbnails/",
+                 jpeg_quality=85, frame_timestamp=1.0, manifest_path=None, executor_backend="thread", cpu_workers=None,
+                 fetch_mode="stream", range_head_bytes=256 * 1024, range_max_bytes=16 * 1024 * 1024, http_timeout=30,
+                 per_host_limit=8, per_host_rate=None, max_retries=3, retry_backoff=0.5, retry_backoff_max=30.0,
+                 storyboard_frames=0, storyboard_tile_size=(160, 90), storyboard_columns=5, storyboard_format="webp",
+                 storyboard_quality=75, renditions=(), frame_selection="fixed", selection_candidates=4,
+                 selection_interval=0.5, selection_max_frames=60, dedupe=False, dedupe_max_distance=6,
+                 phash_index_path=None, metrics_path=None, metrics_interval=10.0, profile_sample_rate=0.0,
+                 profile_dir=None, image_format="jpeg", encoder_backend="cv2", image_quality=None, encode_effort=4,
+                 shard_index=None, shard_count=1, adaptive_concurrency=False, min_concurrency=2, max_concurrency=64,
+                 gallery_index_dir=None, gallery_index_url_prefix=None, gallery_shard_size=500,
+                 decode_backend="thread", decode_workers=None, open_timeout=30.0, seek_timeout=30.0,
+                 read_timeout=30.0, video_timeout=120.0, storage_layout="flat", pack_dir=None,
+                 pack_url_prefix=None, pack_page_size=20, lqip_size=16):
         """
         Khởi tạo generator thumbnail với asyncio
         
@@ -21,19 +1704,358 @@ class VideoThumbnailGenerator:
             output_dir (str): Thư mục lưu thumbnail
             thumbnail_size (tuple): Kích thước thumbnail (width, height)
             concurrent_limit (int): Số lượng tác vụ song song tối đa
+            jpeg_quality (int): Chất lượng JPEG khi lưu thumbnail
+            frame_timestamp (float): Thời điểm lấy frame (giây)
+            manifest_path (str): File manifest cho chế độ incremental (mặc định: <output_dir>/manifest.json)
+            executor_backend (str): "thread" hoặc "process" - nơi chạy resize/encode (CPU-bound)
+            cpu_workers (int): Số worker xử lý ảnh (mặc định: số CPU core)
+            fetch_mode (str): "stream" (cv2 tự đọc URL) hoặc "range" (chỉ tải phần đầu file MP4 bằng HTTP Range)
+            range_head_bytes (int): Số byte đầu file tải trong lần request đầu tiên (chế độ range)
+            range_max_bytes (int): Tổng số byte tối đa tải cho một video trước khi fallback về stream
+            http_timeout (float): Timeout (giây) cho mỗi HTTP request
+            per_host_limit (int): Số kết nối/request đồng thời tối đa tới mỗi host (CDN shard)
+            per_host_rate (float): Số request/giây tối đa tới mỗi host (None = không giới hạn)
+            max_retries (int): Số lần thử lại khi gặp lỗi tạm thời (timeout, 5xx, 429)
+            retry_backoff (float): Thời gian chờ cơ sở (giây) cho exponential backoff
+            retry_backoff_max (float): Thời gian chờ tối đa (giây) giữa hai lần thử
+            storyboard_frames (int): Số frame trong sprite sheet preview khi hover (0 = tắt).
+                Storyboard cần đọc toàn bộ video nên luôn dùng stream, kể cả khi fetch_mode="range"
+            storyboard_tile_size (tuple): Kích thước mỗi ô trong sprite (width, height)
+            storyboard_columns (int): Số cột của sprite
+            storyboard_format (str): "webp" hoặc "jpeg"
+            storyboard_quality (int): Chất lượng nén sprite
+            renditions (tuple): Các chiều rộng thumbnail bổ sung cho srcset (vd: (160, 320, 640)),
+                cùng tỷ lệ với thumbnail_size, resize dạng pyramid từ cùng một frame đã decode
+            frame_selection (str): "fixed" (luôn lấy frame tại frame_timestamp) hoặc "smart"
+                (bỏ frame đen/trống, chọn frame tốt nhất trong vài ứng viên từ cùng capture)
+            selection_candidates (int): Số frame ứng viên tối đa đọc thêm ở chế độ smart
+            selection_interval (float): Khoảng cách (giây) giữa các ứng viên
+            selection_max_frames (int): Ngân sách cứng số frame đọc thêm (kể cả grab) cho mỗi video
+            dedupe (bool): Phát hiện video trùng bằng perceptual hash của frame; video trùng dùng lại
+                thumbnail đã có (không encode/lưu thêm) và được đánh dấu is_duplicate trong kết quả.
+                Chỉ coi là trùng khi thời lượng và tỷ lệ khung hình cũng khớp (PerceptualHashIndex.compatible)
+            dedupe_max_distance (int): Khoảng cách Hamming tối đa (trên 64 bit) để coi hai frame là trùng
+            phash_index_path (str): File hash index (mặc định: <output_dir>/phash_index.json)
+            metrics_path (str): File JSON thống kê thời gian từng stage, byte và lỗi (None = không ghi).
+                File Prometheus được ghi cạnh đó (đổi đuôi thành .prom)
+            metrics_interval (float): Chu kỳ (giây) ghi lại file metrics trong lúc chạy
+            profile_sample_rate (float): Tỷ lệ job được chạy cProfile ở bước đọc frame/xử lý ảnh (0 = tắt)
+            profile_dir (str): Thư mục lưu file .prof (mặc định: <output_dir>/profiles)
+            image_format (str): Định dạng thumbnail và renditions: "jpeg", "webp" hoặc "avif"
+            encoder_backend (str): "cv2" (encode thẳng từ buffer BGR bằng cv2.imencode) hoặc "pil"
+            image_quality (int): Chất lượng nén thumbnail (mặc định: jpeg_quality)
+            encode_effort (int): Mức công sức nén 0-6 cho WebP/AVIF (cao hơn = file nhỏ hơn, chậm hơn)
+            shard_index (int): Chỉ số shard của worker này (0 .. shard_count - 1)
+            shard_count (int): Tổng số shard (> 1 để bật chế độ shard). Mỗi worker chỉ xử lý các dòng
+                có md5(url) % shard_count == shard_index; thumbnail ghi vào thư mục con riêng
+                (<output_dir>/shard-XX-of-YY) và các file manifest/hash index/metrics có hậu tố shard
+            adaptive_concurrency (bool): Tự điều chỉnh số job đồng thời (AIMD) theo latency và tỷ lệ lỗi
+                tạm thời, bắt đầu từ concurrent_limit, trong khoảng [min_concurrency, max_concurrency]
+            min_concurrency (int): Giới hạn dưới khi adaptive_concurrency
+            max_concurrency (int): Giới hạn trên khi adaptive_concurrency
+            gallery_index_dir (str): Thư mục ghi index gallery phân trang (manifest.json + shard JSON
+                nén sẵn) sau mỗi lần chạy (None = không ghi). Ở chế độ shard index được dựng khi ghép kết quả
+            gallery_index_url_prefix (str): Tiền tố URL của thư mục index phía web
+            gallery_shard_size (int): Số video mỗi shard của index
+            decode_backend (str): "thread" (cv2 chạy trong thread I/O) hoặc "process" (worker có watchdog:
+                bước nào quá deadline thì worker bị kill và thay mới, không giữ slot vĩnh viễn)
+            decode_workers (int): Số worker decode tối đa ở chế độ process (mặc định: số job đồng thời tối đa)
+            open_timeout (float): Deadline (giây) mở video; cũng truyền cho FFmpeg qua CAP_PROP_OPEN_TIMEOUT_MSEC
+            seek_timeout (float): Deadline (giây) seek tới frame cần lấy: chế độ process kill worker khi quá hạn,
+                chế độ thread đánh dấu job là timeout sau khi seek trả về
+            read_timeout (float): Deadline (giây) đọc frame; cũng truyền cho FFmpeg qua CAP_PROP_READ_TIMEOUT_MSEC
+            video_timeout (float): Deadline (giây) cho cả lần decode một video (None = không giới hạn).
+                Ở chế độ thread job được giải phóng khi hết giờ nhưng thread chỉ thoát khi FFmpeg tự timeout
+            storage_layout (str): "flat" (tên theo title, một thư mục) hoặc "hashed" (tên theo hash của URL
+                và cấu hình, chia hai cấp thư mục con, xem ThumbnailStore)
+            pack_dir (str): Thư mục ghi pack thumbnail theo trang gallery (None = không đóng gói).
+                Vị trí trong pack được thêm vào kết quả (pack_url, pack_offset, pack_size)
+            pack_url_prefix (str): Tiền tố URL của thư mục pack phía web
+            pack_page_size (int): Số video mỗi trang gallery (khớp videosPerPage của VideoGallery.js)
+            lqip_size (int): Chiều rộng (px) ảnh placeholder nhúng inline dạng data URI WebP trong cột lqip,
+                tạo từ ảnh thumbnail đã resize trong bộ nhớ (0 = tắt)
         """
+        if executor_backend not in ("thread", "process"):
+            raise ValueError("executor_backend phải là 'thread' hoặc 'process'")
+        if fetch_mode not in ("stream", "range"):
+            raise ValueError("fetch_mode phải là 'stream' hoặc 'range'")
+        if storyboard_format not in ("webp", "jpeg"):
+            raise ValueError("storyboard_format phải là 'webp' hoặc 'jpeg'")
+        if decode_backend not in ("thread", "process"):
+            raise ValueError("decode_backend phải là 'thread' hoặc 'process'")
+        if frame_selection not in ("fixed", "smart"):
+            raise ValueError("frame_selection phải là 'fixed' hoặc 'smart'")
+        if shard_count < 1 or (shard_count > 1 and (shard_index is None or not 0 <= shard_index < shard_count)):
+            raise ValueError("shard_index phải nằm trong khoảng [0, shard_count)")
+        self.shard_count = shard_count
+        self.shard_index = shard_index if shard_count > 1 else None
+        if self.is_sharded:
+            # Mọi thứ một shard ghi ra đều tách riêng để nhiều máy chạy song song không đụng nhau
+            shard_name = self.shard_name(self.shard_index, shard_count)
+            output_dir = os.path.join(output_dir, shard_name)
+            web_path_prefix = web_path_prefix.rstrip('/') + '/' + shard_name + '/'
+            manifest_path, phash_index_path, metrics_path = (
+                self.shard_path(path, self.shard_index, shard_count) if path else None
+                for path in (manifest_path, phash_index_path, metrics_path)
+            )
         self.output_dir = output_dir
         self.thumbnail_size = thumbnail_size
         self.concurrent_limit = concurrent_limit
         self.web_path_prefix = web_path_prefix
-        self.semaphore = asyncio.Semaphore(concurrent_limit)
+        self.jpeg_quality = jpeg_quality
+        self.frame_timestamp = frame_timestamp
+        self.manifest_path = manifest_path or os.path.join(output_dir, "manifest.json")
+        self.executor_backend = executor_backend
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.fetch_mode = fetch_mode
+        self.range_head_bytes = range_head_bytes
+        self.range_max_bytes = range_max_bytes
+        self.http_timeout = http_timeout
+        self.per_host_limit = per_host_limit
+        self.per_host_rate = per_host_rate
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.host_limiter = HostRateLimiter(per_host_limit, per_host_rate)
+        self.storyboard_frames = storyboard_frames
+        self.storyboard_tile_size = storyboard_tile_size
+        self.storyboard_columns = storyboard_columns
+        self.storyboard_format = storyboard_format
+        self.storyboard_quality = storyboard_quality
+        self.renditions = tuple(sorted(set(int(width) for width in renditions), reverse=True))
+        self.frame_selection = frame_selection
+        self.selection_candidates = selection_candidates
+        self.selection_interval = selection_interval
+        self.selection_max_frames = selection_max_frames
+        self.dedupe = dedupe
+        self.dedupe_max_distance = dedupe_max_distance
+        self.phash_index_path = phash_index_path or os.path.join(output_dir, "phash_index.json")
+        self.phash_index = None
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir or os.path.join(output_dir, "profiles")
+        self.metrics = StageMetrics()
+        self.image_format = image_format
+        self.encoder_backend = encoder_backend
+        self.image_quality = image_quality if image_quality is not None else jpeg_quality
+        self.encode_effort = encode_effort
+        # Encoder được pickle cùng generator sang process con (chỉ chứa cấu hình)
+        self.encoder = create_encoder(encoder_backend, image_format, self.image_quality, encode_effort)
+        # Chỉ tạo khi bật storyboard: máy không ghi được WebP vẫn dùng được generator khi tắt storyboard
+        self.storyboard_encoder = create_encoder(
+            encoder_backend, storyboard_format, storyboard_quality, encode_effort
+        ) if storyboard_frames else None
+        self.adaptive_concurrency = adaptive_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.gallery_index = GalleryIndexBuilder(
+            gallery_index_dir, gallery_index_url_prefix or "/", gallery_shard_size
+        ) if gallery_index_dir and not self.is_sharded else None
+        self.thumbnail_packs = ThumbnailPackBuilder(
+            pack_dir, pack_url_prefix or "/", pack_page_size
+        ) if pack_dir and not self.is_sharded else None
+        # Giới hạn riêng cho mở stream (network-bound) và xử lý ảnh (CPU-bound)
+        if adaptive_concurrency:
+            self.semaphore = AdaptiveConcurrencyLimiter(
+                concurrent_limit, min_concurrency, max_concurrency,
+                error_types=(TransientFetchError,),
+                on_adjust=self._on_concurrency_adjust
+            )
+        else:
+            self.semaphore = asyncio.Semaphore(concurrent_limit)
+        self.cpu_semaphore = asyncio.Semaphore(self.cpu_workers)
+        self.decode_backend = decode_backend
+        self.decode_workers = decode_workers
+        self.open_timeout = open_timeout
+        self.seek_timeout = seek_timeout
+        self.read_timeout = read_timeout
+        self.video_timeout = video_timeout
+        self._decode_pool = None
+        # Số thread decode bị bỏ lại sau deadline (decode_backend="thread"): close() không chờ chúng
+        self._abandoned_decodes = 0
+        self.storage_layout = storage_layout
+        self.lqip_size = lqip_size
+        self.store = ThumbnailStore(output_dir, web_path_prefix, self.settings_fingerprint(), storage_layout)
+        self._io_executor = None
+        self._cpu_executor = None
+        self._http_session = None
         self.create_output_dir()
     
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._PARENT_ONLY_ATTRS:
+            state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key in self._PARENT_ONLY_ATTRS:
+            self.__dict__.setdefault(key, None)
+    
+    @property
+    def io_executor(self):
+        """Thread pool riêng cho mở stream/đọc frame, kích thước bằng số job đồng thời tối đa"""
+        if self._io_executor is None:
+            self._io_executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="thumb-io")
+        return self._io_executor
+    
+    @property
+    def cpu_executor(self):
+        """Executor cho resize/encode: thread pool hoặc process pool theo số CPU core"""
+        if self._cpu_executor is None:
+            if self.executor_backend == "process":
+                # Worker được tạo lười khi có job (lúc đó đã có thread I/O): không fork process cha
+                self._cpu_executor = ProcessPoolExecutor(
+                    max_workers=self.cpu_workers,
+                    mp_context=_worker_mp_context(),
+                    initializer=_init_process_worker,
+                    initargs=(self,)
+                )
+            else:
+                self._cpu_executor = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix="thumb-cpu")
+        return self._cpu_executor
+    
+    @property
+    def decode_pool(self):
+        """Pool worker decode có watchdog (chế độ decode_backend="process")"""
+        if self._decode_pool is None:
+            self._decode_pool = DecodeWorkerPool(
+                self,
+                self.decode_workers or self.max_in_flight,
+                # Chọn frame đọc thêm vài frame nên dùng chung deadline với read;
+                # storyboard đọc cả video nên chỉ bị giới hạn bởi video_timeout
+                {"open": self.open_timeout, "seek": self.seek_timeout,
+                 "read": self.read_timeout, "select": self.read_timeout},
+                video_timeout=self.video_timeout,
+                wait_executor=self.io_executor,
+                on_kill=self._on_decode_worker_killed
+            )
+        return self._decode_pool
+    
+    def _on_decode_worker_killed(self, info):
+        self.metrics.record_event("decode_workers_killed", info)
+        self.metrics.set_gauge("decode_workers_killed", self._decode_pool.killed)
+    
+    def close(self):
+        """Giải phóng worker decode và các executor (sẽ được tạo lại khi cần)"""
+        # Dừng worker trước: thread I/O có thể đang chờ pipe của worker
+        if self._decode_pool is not None:
+            self._decode_pool.close()
+            self._decode_pool = None
+        for attr in ('_io_executor', '_cpu_executor'):
+            executor = getattr(self, attr)
+            if executor is not None:
+                if attr == '_io_executor' and self._abandoned_decodes:
+                    # Thread decode vượt deadline có thể kẹt trong cv2 vô thời hạn: không chờ,
+                    # huỷ các job còn trong hàng đợi (thread kẹt tự thoát khi FFmpeg ngắt kết nối)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._abandoned_decodes = 0
+                else:
+                    executor.shutdown(wait=True)
+                setattr(self, attr, None)
+    
+    async def close_async(self):
+        """Đóng HTTP session và các executor"""
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+        self.close()
+    
+    @property
+    def http_session(self):
+        """aiohttp session dùng chung (tạo khi cần, trong event loop hiện tại)"""
+        if self._http_session is None:
+            # Connection pool keep-alive dùng chung, giới hạn số kết nối trên từng host
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.per_host_limit,
+                keepalive_timeout=30,
+                ttl_dns_cache=300
+            )
+            self._http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout)
+            )
+        return self._http_session
+    
+    @property
+    def max_in_flight(self):
+        """Số job tối đa có thể chạy cùng lúc (kích thước cửa sổ trượt)"""
+        return self.max_concurrency if self.adaptive_concurrency else self.concurrent_limit
+    
+    @property
+    def current_concurrency(self):
+        return self.semaphore.limit if self.adaptive_concurrency else self.concurrent_limit
+    
+    def _on_concurrency_adjust(self, adjustment):
+        self.metrics.set_gauge("concurrency_limit", adjustment["new"])
+        self.metrics.record_event("concurrency_adjustments", adjustment)
+    
+    @property
+    def is_sharded(self):
+        return self.shard_count > 1
+    
+    @staticmethod
+    def shard_name(shard_index, shard_count):
+        """Tên shard, vd: shard-01-of-04"""
+        width = max(2, len(str(shard_count)))
+        return f"shard-{shard_index:0{width}d}-of-{shard_count:0{width}d}"
+    
+    @staticmethod
+    def shard_path(path, shard_index, shard_count):
+        """Đường dẫn file riêng của shard, vd: vid.csv -> vid.shard-01-of-04.csv"""
+        base, ext = os.path.splitext(path)
+        return f"{base}.{VideoThumbnailGenerator.shard_name(shard_index, shard_count)}{ext}"
+    
+    @staticmethod
+    def shard_of(url, shard_count):
+        """Shard của URL: md5 ổn định giữa các máy/process (không dùng hash() có random seed)"""
+        return int.from_bytes(hashlib.md5(url.encode('utf-8')).digest()[:8], 'big') % shard_count
+    
+    def in_shard(self, url):
+        return not self.is_sharded or self.shard_of(url, self.shard_count) == self.shard_index
+    
     def create_output_dir(self):
         """Tạo thư mục output nếu chưa tồn tại"""
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
     
+    def settings_fingerprint(self):
+        """
+        Fingerprint của cấu hình tạo thumbnail (kích thước, chất lượng, timestamp)
+        
+        Thumbnail tạo với fingerprint khác sẽ được tạo lại ở chế độ incremental.
+        """
+        settings = {
+            "size": list(self.thumbnail_size),
+            "quality": self.image_quality,
+            "timestamp": self.frame_timestamp,
+        }
+        if self.image_format != "jpeg":
+            settings["format"] = [self.image_format, self.encode_effort]
+        if self.storyboard_frames:
+            settings["storyboard"] = [self.storyboard_frames, list(self.storyboard_tile_size),
+                                      self.storyboard_columns, self.storyboard_format, self.storyboard_quality]
+        if self.renditions:
+            settings["renditions"] = list(self.renditions)
+        if self.frame_selection != "fixed":
+            settings["selection"] = [self.frame_selection, self.selection_candidates,
+                                     self.selection_interval, self.selection_max_frames]
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    
+    def required_manifest_columns(self):
+        """
+        Các cột mà entry manifest phải có để được bỏ qua ở chế độ incremental
+
+        Placeholder và metadata không làm đổi file thumbnail nên không nằm trong fingerprint
+        (đổi fingerprint sẽ đổi tên file ở layout hashed); thay vào đó entry thiếu cột thì xử lý lại.
+        """
+        columns = ('source_width',)
+        if self.lqip_size:
+            columns += ('lqip',)
+        return columns
+    
     def clean_filename(self, filename):
         """Làm sạch tên file để phù hợp với hệ điều hành"""
         # Loại bỏ các ký tự không hợp lệ
@@ -78,35 +2100,317 @@ class VideoThumbnailGenerator:
         Returns:
             numpy.ndarray: Frame ảnh hoặc None nếu lỗi
         """
-        async with self.semaphore:  # Giới hạn concurrent
+        try:
+            capture = await self.extract_capture_async(video_url, timestamp)
+        except (DecodeTimeoutError, PermanentFetchError):
+            return None
+        if capture is None:
+            return None
+        # Frame từ worker decode nằm trong shared memory: copy ra trước khi giải phóng block
+        frame = capture["frame"].copy() if capture.get("shared_memory") else capture["frame"]
+        _release_shared_capture(capture)
+        return frame
+    
+    async def extract_capture_async(self, video_url, timestamp=1.0):
+        """
+        Lấy frame thumbnail (và storyboard nếu bật) từ một lần mở video, có retry
+        
+        Returns:
+            dict: {"frame": numpy.ndarray, "storyboard": numpy.ndarray hoặc None} hoặc None nếu lỗi
+        
+        Raises:
+            DecodeTimeoutError: Decode vượt deadline (không thử lại)
+            PermanentFetchError: Server trả lỗi không thể khắc phục bằng thử lại (404, 403, ...)
+        """
+        return await self._retry_async(video_url, lambda: self._extract_once_async(video_url, timestamp))
+    
+    async def _retry_async(self, url, operation):
+        """
+        Chạy operation (trong slot concurrent), thử lại với backoff khi gặp TransientFetchError
+        
+        Args:
+            url (str): URL đang xử lý (để log)
+            operation (callable): Hàm không tham số trả về coroutine
+        
+        Returns:
+            Kết quả của operation hoặc None nếu lỗi
+        
+        Raises:
+            DecodeTimeoutError: Operation vượt deadline
+            PermanentFetchError: Lỗi HTTP không thử lại (404, 403, ...)
+        """
+        for attempt in range(self.max_retries + 1):
             try:
-                # Chạy CV2 trong thread pool vì nó blocking
-                loop = asyncio.get_event_loop()
-                frame = await loop.run_in_executor(
-                    None, 
-                    self._extract_frame_sync, 
-                    video_url, 
-                    timestamp
-                )
-                return frame
-                
+                # Giữ slot concurrent chỉ trong lúc xử lý, không giữ trong lúc chờ backoff
+                async with self.semaphore:
+                    return await operation()
+            except DecodeTimeoutError as e:
+                # Không thử lại: lần thử đã tốn trọn deadline, thử lại chỉ kéo dài thêm đuôi latency
+                print(f"⏱️ {url}: {str(e)}")
+                self.metrics.record_error("timeout", urlparse(url).netloc)
+                raise
+            except PermanentFetchError as e:
+                print(f"✗ {url}: {str(e)}")
+                self.metrics.record_error("http_permanent", urlparse(url).netloc)
+                raise
+            except TransientFetchError as e:
+                if attempt >= self.max_retries:
+                    print(f"Lỗi mạng sau {attempt + 1} lần thử {url}: {str(e)}")
+                    self.metrics.record_error("transient", urlparse(url).netloc)
+                    return None
+                self.metrics.record_error("retry", urlparse(url).netloc)
+                delay = self._backoff_delay(attempt, e.retry_after)
+                print(f"🔁 Thử lại {url} sau {delay:.1f}s ({attempt + 1}/{self.max_retries}): {str(e)}")
+                await asyncio.sleep(delay)
             except Exception as e:
-                print(f"Lỗi async khi xử lý video {video_url}: {str(e)}")
+                print(f"Lỗi async khi xử lý {url}: {str(e)}")
+                self.metrics.record_error("exception", urlparse(url).netloc)
                 return None
+        return None
+    
+    def _backoff_delay(self, attempt, retry_after=None):
+        """Exponential backoff với full jitter, tôn trọng Retry-After của server nếu có"""
+        delay = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.retry_backoff_max))
+        return delay
+    
+    async def _extract_once_async(self, video_url, timestamp):
+        """
+        Một lần thử lấy frame (range hoặc stream), trả về dict như _extract_frame_sync
+        
+        Raises:
+            TransientFetchError: Lỗi mạng tạm thời, người gọi sẽ thử lại
+            PermanentFetchError: Lỗi HTTP không thử lại (404, 403, ...)
+        """
+        partial_path = None
+        is_http = urlparse(video_url).scheme in ("http", "https")
+        host = urlparse(video_url).netloc
+        try:
+            source = video_url
+            if self.fetch_mode == "range" and is_http and not self.storyboard_frames:
+                started = time.perf_counter()
+                try:
+                    partial_path = await self.fetch_partial_video_async(video_url, timestamp)
+                    source = partial_path
+                    self.metrics.observe("fetch_range", time.perf_counter() - started)
+                except RangeFetchUnsupported as e:
+                    print(f"↩️  Không tải một phần được, đọc stream trực tiếp {video_url}: {str(e)}")
+                    self.metrics.record_error("range_unsupported", host)
+            
+            if partial_path is not None:
+                capture = await self._decode_async(source, timestamp)
+            else:
+                # cv2 tự mở kết nối: vẫn tính vào giới hạn của host
+                async with self.host_limiter.limit(host):
+                    capture = await self._decode_async(source, timestamp)
+            
+            if capture is None and partial_path is not None:
+                # Phần dữ liệu đã tải không đủ để decode: fallback về stream
+                self.metrics.record_error("range_decode", host)
+                async with self.host_limiter.limit(host):
+                    capture = await self._decode_async(video_url, timestamp)
+            
+            if capture is None and is_http:
+                # cv2 không cho biết lý do lỗi: probe 1 byte để phân biệt lỗi tạm thời và lỗi thật
+                await self._probe_url_async(video_url)
+            if capture is None:
+                self.metrics.record_error("decode", host)
+            else:
+                self.metrics.observe_all(capture.pop("timings", None))
+            return capture
+        
+        finally:
+            if partial_path is not None:
+                try:
+                    os.remove(partial_path)
+                except OSError:
+                    pass
+    
+    async def _decode_async(self, source, timestamp):
+        """
+        Chạy _extract_frame_sync với deadline: trong worker có watchdog (decode_backend="process")
+        hoặc trong thread pool I/O riêng vì cv2 blocking
+        
+        Raises:
+            DecodeTimeoutError: Decode vượt deadline
+        """
+        if self.decode_backend == "process":
+            return await self.decode_pool.extract(source, timestamp)
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.io_executor, self._extract_frame_sync, source, timestamp)
+        if not self.video_timeout:
+            return await future
+        try:
+            return await asyncio.wait_for(future, self.video_timeout)
+        except asyncio.TimeoutError:
+            # Thread không huỷ được: nó chỉ thoát khi FFmpeg tự timeout, còn job thì được giải phóng ngay
+            self._abandoned_decodes += 1
+            raise DecodeTimeoutError("video", self.video_timeout)
+    
+    async def _probe_url_async(self, video_url):
+        """Gửi request nhỏ để phân loại lỗi (raise TransientFetchError nếu là lỗi tạm thời)"""
+        try:
+            await self._fetch_range_async(video_url, 0, 0)
+        except RangeFetchUnsupported:
+            pass
+    
+    async def _fetch_range_async(self, video_url, start, end):
+        """
+        Tải các byte [start, end] của URL bằng HTTP Range
+        
+        Returns:
+            tuple: (data, total_size) - total_size lấy từ header Content-Range (None nếu không có)
+        """
+        headers = {"Range": f"bytes={start}-{end}"}
+        try:
+            async with self.host_limiter.limit(urlparse(video_url).netloc):
+                async with self.http_session.get(video_url, headers=headers) as response:
+                    if response.status == 416:
+                        return b"", None
+                    self._raise_for_status(response)
+                    if response.status != 206:
+                        raise RangeFetchUnsupported(f"HTTP {response.status} (server không hỗ trợ Range)")
+                    data = await response.read()
+                    self.metrics.add_bytes("http_range", len(data))
+                    content_range = response.headers.get("Content-Range", "")
+                    total_size = content_range.rsplit("/", 1)[-1] if "/" in content_range else ""
+                    return data, int(total_size) if total_size.isdigit() else None
+        except asyncio.TimeoutError:
+            raise TransientFetchError("timeout")
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+            raise TransientFetchError(f"lỗi kết nối: {str(e)}")
+    
+    @staticmethod
+    def _raise_for_status(response):
+        """Phân loại HTTP status: 429/5xx là lỗi tạm thời, 4xx còn lại là lỗi thật"""
+        if response.status == 429 or response.status >= 500:
+            retry_after = response.headers.get("Retry-After", "")
+            raise TransientFetchError(
+                f"HTTP {response.status}",
+                retry_after=float(retry_after) if retry_after.isdigit() else None
+            )
+        if 400 <= response.status < 500:
+            raise PermanentFetchError(f"HTTP {response.status}")
+    
+    async def fetch_partial_video_async(self, video_url, timestamp=1.0):
+        """
+        Tải phần tối thiểu của file MP4 đủ để decode frame quanh timestamp
+        
+        Lấy header container (ftyp/moov) cùng đoạn đầu của mdat, ước lượng số byte media
+        cần thiết từ thời lượng trong mvhd. Nếu moov nằm cuối file thì tải riêng moov.
+        Các đoạn được ghi vào file sparse (đúng offset gốc) trên tmpfs để cv2 decode.
+        
+        Args:
+            video_url (str): Link video MP4
+            timestamp (float): Thời điểm cần lấy frame (giây)
+        
+        Returns:
+            str: Đường dẫn file video tạm (người gọi chịu trách nhiệm xoá)
+        """
+        head, total_size = await self._fetch_range_async(video_url, 0, self.range_head_bytes - 1)
+        header = _parse_mp4_box_header(head)
+        if header is None or header[0] != 'ftyp':
+            raise RangeFetchUnsupported("không phải file MP4/MOV")
+        
+        # Duyệt các box cấp cao nhất để tìm vị trí moov và mdat
+        boxes = {}
+        pos = 0
+        for _ in range(64):
+            if total_size is not None and pos >= total_size:
+                break
+            if pos + 16 <= len(head):
+                header = _parse_mp4_box_header(head, pos)
+            else:
+                data, _ = await self._fetch_range_async(video_url, pos, pos + 15)
+                header = _parse_mp4_box_header(data)
+            if header is None:
+                break
+            box_type, header_size, size = header
+            if size is None:
+                size = (total_size - pos) if total_size is not None else None
+            boxes.setdefault(box_type, (pos, header_size, size))
+            if size is None or size < header_size or ('moov' in boxes and 'mdat' in boxes):
+                break
+            pos += size
+        
+        if 'moov' not in boxes or 'mdat' not in boxes or boxes['moov'][2] is None:
+            raise RangeFetchUnsupported("không tìm thấy moov/mdat")
+        moov_start, _, moov_size = boxes['moov']
+        mdat_start, mdat_header, mdat_size = boxes['mdat']
+        if moov_size > self.range_max_bytes:
+            raise RangeFetchUnsupported(f"moov quá lớn ({moov_size} bytes)")
+        
+        # Lấy moov (có sẵn trong phần đầu hoặc tải riêng khi moov nằm cuối file)
+        if moov_start + moov_size <= len(head):
+            moov = head[moov_start:moov_start + moov_size]
+        else:
+            moov, _ = await self._fetch_range_async(video_url, moov_start, moov_start + moov_size - 1)
+        
+        # Ước lượng số byte media cần cho khoảng [0, timestamp + cửa sổ chọn frame] (giả định bitrate đều)
+        duration = _parse_mp4_duration(moov)
+        media_size = (mdat_size or self.range_max_bytes) - mdat_header
+        if duration and duration > 0:
+            fraction = min(1.0, (timestamp + self._frame_window_seconds()) / duration)
+        else:
+            fraction = 1.0
+        media_end = mdat_start + mdat_header + int(media_size * fraction) + 64 * 1024
+        media_end = min(media_end, mdat_start + (mdat_size or media_end))
+        
+        # Phần đầu file liên tục tới hết đoạn media cần dùng (bao gồm moov nếu moov đứng trước mdat)
+        prefix_end = max(media_end, moov_start + moov_size) if moov_start < mdat_start else media_end
+        if prefix_end > self.range_max_bytes:
+            raise RangeFetchUnsupported(f"cần tải {prefix_end} bytes, vượt giới hạn {self.range_max_bytes}")
+        prefix = head[:prefix_end]
+        if len(prefix) < prefix_end:
+            rest, _ = await self._fetch_range_async(video_url, len(prefix), prefix_end - 1)
+            prefix += rest
+        
+        # Ghi file sparse: các đoạn nằm đúng offset gốc nên offset trong moov vẫn hợp lệ
+        fd, partial_path = tempfile.mkstemp(suffix='.mp4', prefix='thumb_', dir=_partial_video_dir())
+        with os.fdopen(fd, 'wb') as f:
+            f.write(prefix)
+            if moov_start > mdat_start:
+                f.seek(moov_start)
+                f.write(moov)
+        return partial_path
     
+    @_sampled_profile("extract")
     def _extract_frame_sync(self, video_url, timestamp):
-        """Hàm đồng bộ để trích xuất frame (được gọi trong thread pool)"""
+        """
+        Hàm đồng bộ để trích xuất frame (được gọi trong thread pool)
+        
+        Returns:
+            dict: {"frame": numpy.ndarray, "storyboard": numpy.ndarray hoặc None,
+            "metadata": {"fps", "frame_count", "duration"}, "timings": {stage: giây}} hoặc None nếu lỗi
+        
+        Raises:
+            DecodeTimeoutError: FFmpeg ngắt open/seek/read vì quá timeout
+        """
+        cap = None
         try:
+            timer = StageTimer()
             # Mở video từ URL
-            cap = cv2.VideoCapture(video_url)
+            self._enter_stage("open")
+            cap = self._open_capture(video_url)
+            timer.mark("open")
             
             if not cap.isOpened():
+                self._check_stage_timeout(timer, "open", self.open_timeout)
                 print(f"Không thể mở video: {video_url}")
                 return None
             
             # Lấy FPS và tổng số frame
             fps = cap.get(cv2.CAP_PROP_FPS)
             total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            # Metadata của video lấy luôn từ capture đang mở (trước khi thay FPS mặc định)
+            metadata = {}
+            if fps > 0:
+                metadata["fps"] = round(fps, 3)
+            if total_frames > 0:
+                metadata["frame_count"] = total_frames
+                if fps > 0:
+                    metadata["duration"] = round(total_frames / fps, 3)
             
             if fps <= 0:
                 fps = 30  # Default FPS
@@ -115,22 +2419,214 @@ class VideoThumbnailGenerator:
             frame_number = min(int(timestamp * fps), total_frames - 1)
             
             # Di chuyển đến frame cần thiết
+            self._enter_stage("seek")
             cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            timer.mark("seek")
+            # Chế độ thread không kill được seek đang chạy: seek xong mà đã quá hạn thì vẫn tính là timeout
+            self._check_stage_timeout(timer, "seek", self.seek_timeout)
             
             # Đọc frame
+            self._enter_stage("read")
             ret, frame = cap.read()
-            cap.release()
+            timer.mark("read")
             
-            if ret:
-                return frame
-            else:
+            if not ret:
+                cap.release()
+                # Seek trong FFmpeg cũng đọc packet nên chịu read timeout
+                self._check_stage_timeout(timer, "seek", self.read_timeout)
+                self._check_stage_timeout(timer, "read", self.read_timeout)
                 print(f"Không thể đọc frame từ video: {video_url}")
                 return None
-                
+            
+            capture = {"frame": frame, "storyboard": None, "metadata": metadata}
+            position = frame_number + 1
+            if self.frame_selection == "smart":
+                # Chọn frame tốt nhất từ các ứng viên phía sau, vẫn trên capture đang mở
+                self._enter_stage("select")
+                frame, chosen_number, score, position = self._select_frame_sync(cap, fps, frame, frame_number)
+                capture.update({
+                    "frame": frame,
+                    "frame_time": round(chosen_number / fps, 3),
+                    "frame_score": round(score, 2),
+                })
+                timer.mark("select")
+            
+            # Storyboard lấy tiếp từ capture đang mở, không mở lại video
+            if self.storyboard_frames and total_frames > 0:
+                self._enter_stage("storyboard_read")
+                capture["storyboard"] = self._read_storyboard_sync(cap, fps, total_frames, position)
+                timer.mark("storyboard_read")
+            cap.release()
+            
+            capture["timings"] = timer.timings
+            return capture
+        
+        except DecodeTimeoutError:
+            if cap is not None:
+                cap.release()
+            raise
         except Exception as e:
             print(f"Lỗi sync khi xử lý video {video_url}: {str(e)}")
             return None
     
+    def _enter_stage(self, stage):
+        """Báo bước decode sắp chạy cho watchdog (chỉ có tác dụng trong worker decode có giám sát)"""
+        if self._stage_callback is not None:
+            self._stage_callback(stage)
+    
+    def _open_capture(self, source):
+        """Mở cv2.VideoCapture, truyền open/read timeout cho FFmpeg để bản thân FFmpeg cũng tự ngắt"""
+        params = []
+        if self.open_timeout:
+            params += [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, int(self.open_timeout * 1000)]
+        if self.read_timeout:
+            params += [cv2.CAP_PROP_READ_TIMEOUT_MSEC, int(self.read_timeout * 1000)]
+        return cv2.VideoCapture(source, cv2.CAP_ANY, params) if params else cv2.VideoCapture(source)
+    
+    @staticmethod
+    def _check_stage_timeout(timer, stage, seconds):
+        """FFmpeg không cho biết lý do lỗi: bước lỗi mất ít nhất bằng timeout thì coi là timeout"""
+        if seconds and timer.timings.get(stage, 0.0) >= seconds:
+            raise DecodeTimeoutError(stage, seconds)
+    
+    @staticmethod
+    def score_frame(frame):
+        """
+        Chấm điểm frame trên bản thu nhỏ 64x36 bằng các phép tính vector NumPy
+        
+        Returns:
+            tuple: (score, is_blank) - score cao hơn là frame nhiều chi tiết hơn;
+            is_blank True với frame đen, trắng hoặc gần như một màu (fade-in/out)
+        """
+        small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA).astype(np.float32)
+        # Độ sáng (BGR -> luma Rec.601)
+        luma = small @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+        mean = float(luma.mean())
+        std = float(luma.std())
+        # Năng lượng cạnh: trung bình độ lệch giữa các pixel kề nhau theo hai chiều
+        edge = float(np.abs(np.diff(luma, axis=1)).mean() + np.abs(np.diff(luma, axis=0)).mean())
+        is_blank = mean < 20 or mean > 235 or std < 8
+        return std + 2 * edge, is_blank
+    
+    def _frame_window_seconds(self):
+        """Khoảng thời gian (giây) sau frame_timestamp có thể cần đọc để lấy thumbnail"""
+        if self.frame_selection == "smart":
+            return 1.0 + self.selection_candidates * self.selection_interval
+        return 1.0
+    
+    def _select_frame_sync(self, cap, fps, frame, frame_number):
+        """
+        Bỏ frame đen/trống: nếu frame ban đầu ổn thì giữ luôn (không đọc thêm frame nào),
+        ngược lại đọc tối đa selection_candidates ứng viên cách nhau selection_interval giây
+        (grab() các frame ở giữa) trong ngân sách selection_max_frames và giữ frame điểm cao nhất.
+        
+        Returns:
+            tuple: (frame, frame_number, score, position) - position là vị trí hiện tại của capture
+        """
+        score, is_blank = self.score_frame(frame)
+        position = frame_number + 1
+        if not is_blank:
+            return frame, frame_number, score, position
+        
+        best = (frame, frame_number, score, is_blank)
+        budget = self.selection_max_frames
+        step = max(1, min(int(self.selection_interval * fps), budget // max(1, self.selection_candidates)))
+        for _ in range(self.selection_candidates):
+            if budget < step:
+                break
+            # Bỏ qua các frame ở giữa bằng grab() (không chuyển đổi màu), frame cuối mới read()
+            skipped = 0
+            while skipped < step - 1 and cap.grab():
+                skipped += 1
+            ret, candidate = cap.read()
+            budget -= step
+            position += skipped + 1
+            if not ret:
+                break
+            candidate_score, candidate_blank = self.score_frame(candidate)
+            # Frame không trống luôn thắng frame trống, cùng loại thì so điểm
+            if (best[3] and not candidate_blank) or (candidate_blank == best[3] and candidate_score > best[2]):
+                best = (candidate, position - 1, candidate_score, candidate_blank)
+        return best[0], best[1], best[2], position
+    
+    def _read_storyboard_sync(self, cap, fps, total_frames, position):
+        """
+        Đọc storyboard_frames frame cách đều nhau từ capture đang mở và ghép thành sprite
+        
+        Khi các frame mẫu gần nhau thì đọc tuần tự bằng grab() (không decode frame bỏ qua),
+        còn khi cách xa thì seek tới từng vị trí (ffmpeg seek về keyframe).
+        
+        Args:
+            cap (cv2.VideoCapture): Capture đang mở
+            fps (float): FPS của video
+            total_frames (int): Tổng số frame
+            position (int): Vị trí hiện tại của capture (frame kế tiếp sẽ đọc)
+        
+        Returns:
+            numpy.ndarray: Ảnh sprite (BGR) hoặc None nếu không đọc được frame nào
+        """
+        count = self.storyboard_frames
+        tile_w, tile_h = self.storyboard_tile_size
+        columns = max(1, min(self.storyboard_columns, count))
+        rows = (count + columns - 1) // columns
+        targets = [min(int(total_frames * (k + 0.5) / count), total_frames - 1) for k in range(count)]
+        # Đọc tuần tự nếu khoảng cách giữa các mẫu không quá 2 giây
+        sequential = (total_frames / count) <= 2 * fps
+        
+        sprite = np.zeros((rows * tile_h, columns * tile_w, 3), dtype=np.uint8)
+        read_count = 0
+        for k, target in enumerate(targets):
+            if sequential and position <= target:
+                while position < target:
+                    if not cap.grab():
+                        break
+                    position += 1
+            else:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+                position = target
+            ret, tile = cap.read()
+            if not ret:
+                break
+            position += 1
+            read_count += 1
+            row, col = divmod(k, columns)
+            sprite[row * tile_h:(row + 1) * tile_h, col * tile_w:(col + 1) * tile_w] = self._letterbox(tile, (tile_w, tile_h))
+        return sprite if read_count else None
+    
+    @staticmethod
+    def _letterbox(frame, size):
+        """Resize frame vào khung size (width, height) giữ nguyên tỷ lệ, phần thừa để nền đen"""
+        # Lấy kích thước gốc của frame
+        h, w = frame.shape[:2]
+        target_w, target_h = size
+        
+        # Tính toán tỷ lệ để giữ nguyên aspect ratio
+        aspect_ratio = w / h
+        target_aspect = target_w / target_h
+        
+        if aspect_ratio > target_aspect:  # Ảnh rộng hơn
+            # Lấy chiều rộng tối đa, tính chiều cao tương ứng
+            new_w = target_w
+            new_h = int(new_w / aspect_ratio)
+        else:  # Ảnh cao hơn hoặc bằng
+            # Lấy chiều cao tối đa, tính chiều rộng tương ứng
+            new_h = target_h
+            new_w = int(new_h * aspect_ratio)
+        
+        # Resize frame giữ nguyên tỷ lệ
+        frame_resized = cv2.resize(frame, (new_w, new_h))
+        
+        # Tạo ảnh nền đen với kích thước target
+        background = np.zeros((target_h, target_w, 3), dtype=np.uint8)
+        
+        # Tính toán vị trí để căn giữa ảnh
+        y_offset = (target_h - new_h) // 2
+        x_offset = (target_w - new_w) // 2
+        
+        # Đặt ảnh đã resize vào giữa background
+        background[y_offset:y_offset+new_h, x_offset:x_offset+new_w] = frame_resized
+        return background
+    
     async def create_thumbnail_async(self, video_url, title=None):
         """
         Tạo thumbnail cho một video (async)
@@ -140,221 +2636,564 @@ class VideoThumbnailGenerator:
             title (str): Title của video từ CSV
         
         Returns:
-            dict: {"success": bool, "thumbnail_path": str, "error": str}
+            dict: {"success": bool, "thumbnail_path": str, "error": str} - khi lỗi có thêm
+            "error_category": "timeout", "http_permanent", "extract", "process" hoặc "exception"
         """
         try:
-            # Lấy frame từ video
-            frame = await self.extract_thumbnail_from_stream_async(video_url, timestamp=1.0)
+            # Lấy frame (và storyboard) từ video
+            try:
+                capture = await self.extract_capture_async(video_url, timestamp=self.frame_timestamp)
+            except DecodeTimeoutError as e:
+                return {"success": False, "thumbnail_path": None, "error": f"Quá thời gian: {str(e)}",
+                        "error_category": "timeout"}
+            except PermanentFetchError as e:
+                # Lỗi của URL (404, 403, ...): tách khỏi lỗi decode để báo cáo/thử lại riêng
+                return {"success": False, "thumbnail_path": None, "error": f"Lỗi HTTP: {str(e)}",
+                        "error_category": "http_permanent"}
             
-            if frame is None:
-                return {"success": False, "thumbnail_path": None, "error": "Không thể lấy frame"}
+            if capture is None:
+                return {"success": False, "thumbnail_path": None, "error": "Không thể lấy frame",
+                        "error_category": "extract"}
             
-            # Xử lý ảnh trong thread pool (vì PIL/CV2 blocking)
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                None, 
-                self._process_frame_sync, 
-                frame, 
-                video_url, 
-                title
-            )
+            try:
+                phash = None
+                # Frame đen/một màu cho dHash gần như toàn 0 nên không dùng để so trùng
+                if self.phash_index is not None and not self.score_frame(capture["frame"])[1]:
+                    # Hash 9x8 rất rẻ nên tính ngay ở process cha, trước khi tốn công encode
+                    phash = PerceptualHashIndex.dhash(capture["frame"])
+                    signature = ((capture.get("metadata") or {}).get("duration"),
+                                 self._source_dimensions(capture["frame"])["aspect_ratio"])
+                    match = self.phash_index.find(phash, *signature)
+                    # Bản trùng đang được encode song song: chờ xong rồi dùng lại thay vì encode lần nữa
+                    while match is None and await self.phash_index.wait_pending(phash):
+                        match = self.phash_index.find(phash, *signature)
+                    if match is not None:
+                        return self._duplicate_result(video_url, phash, *match, capture=capture)
+                    self.phash_index.reserve(phash)
             
-            return result
+                # Xử lý ảnh trong cpu executor (vì PIL/CV2 blocking)
+                try:
+                    result = await self.process_frame_async(capture["frame"], video_url, title,
+                                                            storyboard=capture.get("storyboard"),
+                                                            shared=capture.get("shared_memory"))
+                finally:
+                    if phash is not None:
+                        self.phash_index.release(phash)
+                self.metrics.observe_all(result.pop("timings", None))
+                self.metrics.add_bytes("thumbnail_written", result.pop("bytes_written", 0))
+                if not result["success"]:
+                    result.setdefault("error_category", "process")
+                    self.metrics.record_error("process", urlparse(video_url).netloc)
+                if result["success"] and "frame_time" in capture:
+                    result.update({"frame_time": capture["frame_time"], "frame_score": capture["frame_score"]})
+                if result["success"]:
+                    result.update(capture.get("metadata") or {})
+                if result["success"] and phash is not None:
+                    result.update({"phash": f"{phash:016x}", "is_duplicate": False, "duplicate_of": ""})
+                    self.phash_index.add(phash, video_url, result, self._extra_result_columns(result))
+                return result
+            finally:
+                # Frame từ worker decode (decode_backend="process") nằm trong shared memory
+                _release_shared_capture(capture)
             
         except Exception as e:
             error_msg = f"Lỗi khi tạo thumbnail: {str(e)}"
             print(f"✗ {video_url}: {error_msg}")
-            return {"success": False, "thumbnail_path": None, "error": error_msg}
+            self.metrics.record_error("exception", urlparse(video_url).netloc)
+            return {"success": False, "thumbnail_path": None, "error": error_msg, "error_category": "exception"}
+    
+    def _duplicate_result(self, video_url, phash, distance, entry, capture=None):
+        """
+        Kết quả cho video trùng: dùng lại thumbnail (và sprite, srcset, lqip, ...) của video gốc,
+        còn kích thước/thời lượng/fps lấy từ chính capture của video trùng (có thể khác độ phân giải, độ dài)
+        """
+        result = {"success": True, "thumbnail_path": entry['thumbnail_path'], "web_path": entry['web_path'], "error": None}
+        columns = entry.get('columns', {})
+        result.update({column: columns[column] for column in self.REUSABLE_COLUMNS if column in columns})
+        if capture is not None:
+            result.update(self._source_dimensions(capture["frame"]))
+            result.update(capture.get("metadata") or {})
+            if "frame_time" in capture:
+                result.update({"frame_time": capture["frame_time"], "frame_score": capture["frame_score"]})
+        result.update({"phash": f"{phash:016x}", "is_duplicate": True, "duplicate_of": entry['url']})
+        print(f"♻️ Trùng với {entry['url']} (khoảng cách {distance}): dùng lại {os.path.basename(entry['thumbnail_path'])}")
+        return result
+    
+    async def process_frame_async(self, frame, video_url, title, storyboard=None, shared=None):
+        """
+        Chạy _process_frame_sync trên cpu executor (giới hạn bởi cpu_workers)
+        
+        Với backend "process", frame được chuyển qua shared memory thay vì pickle cả mảng.
+        
+        Args:
+            shared (dict): {key: (SharedMemory, frame_ref)} - mảng đã nằm sẵn trong shared memory
+                (từ worker decode) thì dùng lại ref, không copy thêm
+        """
+        async with self.cpu_semaphore:
+            loop = asyncio.get_event_loop()
+            if self.executor_backend != "process":
+                return await loop.run_in_executor(
+                    self.cpu_executor,
+                    functools.partial(self._process_frame_sync, frame, video_url, title, storyboard=storyboard)
+                )
+            
+            blocks = []
+            frame_refs = {}
+            try:
+                for key, array in (("frame", frame), ("storyboard", storyboard)):
+                    if array is None:
+                        frame_refs[key] = None
+                        continue
+                    if shared and key in shared:
+                        frame_refs[key] = shared[key][1]
+                        continue
+                    shm, frame_refs[key] = _frame_to_shared_memory(array)
+                    blocks.append(shm)
+                return await loop.run_in_executor(
+                    self.cpu_executor,
+                    _process_frame_worker,
+                    frame_refs,
+                    video_url,
+                    title
+                )
+            finally:
+                for shm in blocks:
+                    shm.close()
+                    shm.unlink()
     
-    def _process_frame_sync(self, frame, video_url, title):
+    @_sampled_profile("process")
+    def _process_frame_sync(self, frame, video_url, title, storyboard=None):
         """Xử lý frame thành thumbnail (chạy trong thread pool)"""
         try:
-            # Lấy kích thước gốc của frame
-            h, w = frame.shape[:2]
-            target_w, target_h = self.thumbnail_size
-            
-            # Tính toán tỷ lệ để giữ nguyên aspect ratio
-            aspect_ratio = w / h
-            target_aspect = target_w / target_h
+            timer = StageTimer()
+            # Pyramid các kích thước: mức lớn nhất lấy từ frame gốc, các mức sau resize từ mức trước
+            levels = self._build_rendition_pyramid(frame)
+            background = levels[self.thumbnail_size[0]]
+            timer.mark("resize")
             
-            if aspect_ratio > target_aspect:  # Ảnh rộng hơn
-                # Lấy chiều rộng tối đa, tính chiều cao tương ứng
-                new_w = target_w
-                new_h = int(new_w / aspect_ratio)
-            else:  # Ảnh cao hơn hoặc bằng
-                # Lấy chiều cao tối đa, tính chiều rộng tương ứng
-                new_h = target_h
-                new_w = int(new_h * aspect_ratio)
-            
-            # Resize frame giữ nguyên tỷ lệ
-            frame_resized = cv2.resize(frame, (new_w, new_h))
-            
-            # Tạo ảnh nền đen với kích thước target
-            background = np.zeros((target_h, target_w, 3), dtype=np.uint8)
-            
-            # Tính toán vị trí để căn giữa ảnh
-            y_offset = (target_h - new_h) // 2
-            x_offset = (target_w - new_w) // 2
-            
-            # Đặt ảnh đã resize vào giữa background
-            background[y_offset:y_offset+new_h, x_offset:x_offset+new_w] = frame_resized
-            
-            # Chuyển từ BGR sang RGB
-            frame_rgb = cv2.cvtColor(background, cv2.COLOR_BGR2RGB)
-            
-            # Tạo tên file từ title và timestamp
-            if title:
+            # Layout flat: tên file từ title và timestamp; layout hashed: tên từ hash của URL + cấu hình
+            name = None
+            if title and self.storage_layout == "flat":
                 clean_title, timestamp = self.extract_title_and_timestamp(title)
-                filename = f"{clean_title}_{timestamp}.jpg"
-            else:
-                filename = f"video_{int(time.time())}_{hash(video_url) % 10000}.jpg"
-            
-            filepath = os.path.join(self.output_dir, filename)
+                name = f"{clean_title}_{timestamp}"
+            filepath = self.store.path_for(video_url, self.encoder.extension, name)
             
-            # Đảm bảo tên file unique nếu đã tồn tại
-            counter = 1
-            original_filepath = filepath
-            while os.path.exists(filepath):
-                name, ext = os.path.splitext(original_filepath)
-                filepath = f"{name}_{counter}{ext}"
-                counter += 1
-            
-            # Lưu thumbnail
-            pil_image = Image.fromarray(frame_rgb)
-            pil_image.save(filepath, 'JPEG', quality=85)
+            # Encode vào bộ nhớ rồi ghi file tạm + rename (đo riêng thời gian encode và ghi đĩa)
+            encoded = self.encoder.encode(background)
+            timer.mark("encode")
+            _atomic_write(filepath, encoded)
+            timer.mark("write")
             
             # Tạo web path cho thumbnail
-            web_path = self.web_path_prefix + os.path.basename(filepath)
+            web_path = self.store.web_path(filepath)
+            
+            result = {"success": True, "thumbnail_path": filepath, "web_path": web_path, "error": None,
+                      "format": self.image_format, "bytes_written": len(encoded)}
+            result.update(self._source_dimensions(frame))
+            if self.lqip_size:
+                result["lqip"] = self._lqip_data_uri(levels[min(levels)])
+                timer.mark("lqip")
+            if self.renditions:
+                result.update(self._save_renditions_sync(levels, filepath))
+                timer.mark("renditions")
+            if storyboard is not None:
+                result.update(self._save_storyboard_sync(storyboard, filepath))
+                timer.mark("storyboard_save")
+            result["timings"] = timer.timings
             
             print(f"✓ Đã tạo thumbnail: {os.path.basename(filepath)}")
-            return {"success": True, "thumbnail_path": filepath, "web_path": web_path, "error": None}
+            return result
             
         except Exception as e:
             error_msg = f"Lỗi khi xử lý frame: {str(e)}"
             return {"success": False, "thumbnail_path": None, "error": error_msg}
     
-    async def process_csv_batch_async(self, csv_file_path):
+    @staticmethod
+    def _source_dimensions(frame):
+        """Kích thước thật của video (từ frame đã decode) để client dựng layout trước khi ảnh tải xong"""
+        source_h, source_w = frame.shape[:2]
+        return {"source_width": source_w, "source_height": source_h,
+                "aspect_ratio": round(source_w / source_h, 4) if source_h else ""}
+    
+    def _lqip_data_uri(self, image):
+        """
+        Placeholder siêu nhỏ (lqip_size px, cùng tỷ lệ thumbnail) dạng data URI WebP (~200 ký tự),
+        resize INTER_AREA từ mức nhỏ nhất của pyramid nên không decode hay resize lại frame gốc
+        """
+        target_w, target_h = self.thumbnail_size
+        size = (self.lqip_size, max(1, int(round(self.lqip_size * target_h / target_w))))
+        small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.webp', small, [cv2.IMWRITE_WEBP_QUALITY, 40])
+        mime = 'image/webp'
+        if not ok:
+            ok, buffer = cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 40])
+            mime = 'image/jpeg'
+        return f"data:{mime};base64,{base64.b64encode(buffer.tobytes()).decode('ascii')}" if ok else ""
+    
+    def _rendition_size(self, width):
+        """Kích thước (width, height) của rendition, cùng tỷ lệ với thumbnail_size"""
+        target_w, target_h = self.thumbnail_size
+        return width, max(1, int(round(width * target_h / target_w)))
+    
+    def _build_rendition_pyramid(self, frame):
+        """
+        Tạo ảnh cho thumbnail chính và tất cả renditions từ một frame
+        
+        Chỉ mức lớn nhất được resize từ frame gốc (letterbox), các mức nhỏ hơn
+        resize INTER_AREA từ mức ngay trên nên chi phí giảm dần theo từng mức.
+        
+        Returns:
+            dict: {width: ảnh BGR}
+        """
+        widths = sorted(set(self.renditions) | {self.thumbnail_size[0]}, reverse=True)
+        levels = {}
+        previous = None
+        for width in widths:
+            if width == self.thumbnail_size[0]:
+                size = tuple(self.thumbnail_size)
+            else:
+                size = self._rendition_size(width)
+            if previous is None:
+                levels[width] = self._letterbox(frame, size)
+            else:
+                levels[width] = cv2.resize(previous, size, interpolation=cv2.INTER_AREA)
+            previous = levels[width]
+        return levels
+    
+    def _save_renditions_sync(self, levels, thumbnail_path):
+        """
+        Lưu các rendition cạnh thumbnail (rendition trùng kích thước thumbnail dùng lại file chính)
+        
+        Returns:
+            dict: {"srcset": str, "rendition_paths": str (JSON {width: path})}
+        """
+        base, ext = os.path.splitext(thumbnail_path)
+        srcset = []
+        paths = {}
+        for width in sorted(self.renditions):
+            if width == self.thumbnail_size[0]:
+                path = thumbnail_path
+            else:
+                path = f"{base}_{width}w{ext}"
+                _atomic_write(path, self.encoder.encode(levels[width]))
+            paths[str(width)] = path
+            srcset.append(f"{self.store.web_path(path)} {width}w")
+        return {"srcset": ", ".join(srcset), "rendition_paths": json.dumps(paths, ensure_ascii=False)}
+    
+    def _save_storyboard_sync(self, storyboard, thumbnail_path):
+        """
+        Lưu sprite storyboard cạnh thumbnail
+        
+        Returns:
+            dict: Các cột sprite_* cho kết quả
+        """
+        tile_w, tile_h = self.storyboard_tile_size
+        columns = storyboard.shape[1] // tile_w
+        rows = storyboard.shape[0] // tile_h
+        sprite_path = f"{os.path.splitext(thumbnail_path)[0]}_sprite{self.storyboard_encoder.extension}"
+        _atomic_write(sprite_path, self.storyboard_encoder.encode(storyboard))
+        
+        return {
+            "sprite_path": sprite_path,
+            "sprite_web_path": self.store.web_path(sprite_path),
+            "sprite_grid": f"{columns}x{rows}",
+            "sprite_tile": f"{tile_w}x{tile_h}",
+            "sprite_frames": self.storyboard_frames,
+        }
+    
+    def _extra_result_columns(self, result):
+        """Các cột bổ sung (sprite, ...) có trong kết quả để ghi vào vid.csv và manifest"""
+        return {column: result[column] for column in self.RESULT_COLUMNS if column in result}
+    
+    @staticmethod
+    def iter_csv_rows(csv_file_path, chunksize=1000):
+        """
+        Đọc CSV theo từng chunk và trả về lần lượt từng dòng (không nạp toàn bộ file vào bộ nhớ)
+        
+        Yields:
+            tuple: (idx, row) với row là dict các cột của dòng
+        """
+        idx = 0
+        for chunk in pd.read_csv(csv_file_path, chunksize=chunksize, dtype=str, keep_default_na=False):
+            if 'url' not in chunk.columns:
+                raise ValueError("CSV phải có cột 'url'")
+            if 'title' not in chunk.columns:
+                chunk['title'] = ''
+            for row in chunk.to_dict('records'):
+                yield idx, row
+                idx += 1
+    
+    @staticmethod
+    def count_csv_rows(csv_file_path):
+        """Đếm số dòng dữ liệu của CSV (duyệt một lượt bằng csv module, không giữ dữ liệu)"""
+        import csv
+        with open(csv_file_path, 'r', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # Bỏ qua header
+            return sum(1 for _ in reader)
+    
+    async def iter_results_async(self, rows):
+        """
+        Scheduler dạng cửa sổ trượt: luôn giữ đúng max_in_flight video đang xử lý
+        (với adaptive_concurrency, số job thực sự chạy do AdaptiveConcurrencyLimiter quyết định)
+        
+        Dòng input được lấy dần từ iterator khi có slot trống, kết quả trả về ngay khi
+        từng video xong (không theo thứ tự input), không có barrier giữa các batch.
+        
+        Args:
+            rows (iterable): Các tuple (idx, row) với row có 'url' và 'title'
+        
+        Yields:
+            tuple: (idx, row, result) với result là dict từ create_thumbnail_async
+        """
+        rows = iter(rows)
+        pending = {}
+        
+        def submit_next():
+            try:
+                idx, row = next(rows)
+            except StopIteration:
+                return False
+            task = asyncio.ensure_future(self.create_thumbnail_async(row['url'], row.get('title')))
+            pending[task] = (idx, row)
+            return True
+        
+        while len(pending) < self.max_in_flight and submit_next():
+            pass
+        
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    idx, row = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        result = {"success": False, "thumbnail_path": None, "error": str(e)}
+                    # Nạp job mới trước khi trả kết quả để slot không bị bỏ trống
+                    submit_next()
+                    yield idx, row, result
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def process_csv_batch_async(self, csv_file_path, incremental=False, seed_csv_path=None, output_csv_path="vid.csv"):
         """
-        Đọc CSV và tạo thumbnail cho tất cả video (async với concurrent 20)
+        Đọc CSV và tạo thumbnail cho tất cả video (async, cửa sổ trượt concurrent_limit job)
+        
+        Kết quả được ghi nối vào journal (<output_csv_path>.journal.jsonl) ngay khi từng job xong,
+        cuối lần chạy mới compact một lần thành output_csv_path (ghi file tạm rồi rename).
         
         Args:
             csv_file_path (str): Đường dẫn file CSV input
+            incremental (bool): Chỉ xử lý URL mới, lỗi, mất file hoặc khác cấu hình (dựa trên manifest).
+                Journal còn sót lại từ lần chạy bị ngắt sẽ được khôi phục vào manifest để resume
+            seed_csv_path (str): vid.csv cũ để khởi tạo manifest nếu manifest chưa tồn tại
+            output_csv_path (str): File CSV kết quả
         
         Returns:
             pandas.DataFrame: DataFrame với kết quả
         """
+        manifest = None
+        journal = None
         try:
-            # Đọc CSV
             print(f"Đọc file CSV: {csv_file_path}")
-            df = pd.read_csv(csv_file_path)
+            total = self.count_csv_rows(csv_file_path)
             
-            if 'url' not in df.columns:
-                raise ValueError("CSV phải có cột 'url'")
-            
-            # Đảm bảo có cột title
-            if 'title' not in df.columns:
-                df['title'] = ''
+            print(f"Tìm thấy {total} video trong CSV")
+            if self.is_sharded:
+                total = sum(1 for _, row in self.iter_csv_rows(csv_file_path) if self.in_shard(row['url']))
+                print(f"🧩 Shard {self.shard_index + 1}/{self.shard_count}: {total} video thuộc shard này")
+            if self.adaptive_concurrency:
+                print(f"Sử dụng concurrent limit tự điều chỉnh: bắt đầu {self.current_concurrency} "
+                      f"(khoảng {self.min_concurrency}-{self.max_concurrency})")
+            else:
+                print(f"Sử dụng concurrent limit: {self.concurrent_limit}")
             
-            print(f"Tìm thấy {len(df)} video trong CSV")
-            print(f"Sử dụng concurrent limit: {self.concurrent_limit}")
+            fingerprint = self.settings_fingerprint()
+            required_columns = self.required_manifest_columns()
+            self.metrics = StageMetrics()
+            self.metrics.set_gauge("concurrency_limit", self.current_concurrency)
+            last_metrics_write = time.time()
+            journal = ResultsJournal(output_csv_path + ".journal.jsonl")
+            if incremental:
+                manifest_exists = os.path.exists(self.manifest_path)
+                manifest = ThumbnailManifest(self.manifest_path)
+                if not manifest_exists and seed_csv_path:
+                    # Manifest của shard chỉ nhận URL của shard đó, không giữ bản sao cũ của shard khác
+                    seeded = manifest.seed_from_csv(seed_csv_path, fingerprint, include=self.in_shard,
+                                                    columns=self.RESULT_COLUMNS)
+                    # vid.csv cũ thiếu cột mới (vd: lqip): các dòng đó vẫn sẽ được xử lý lại
+                    stale = sum(1 for entry in manifest.entries.values()
+                                if any(column not in entry['columns'] for column in required_columns))
+                    if seeded and stale:
+                        print(f"⚠️ {stale}/{seeded} thumbnail nhập từ {seed_csv_path} thiếu cột "
+                              f"{', '.join(required_columns)}, sẽ được tạo lại")
+                # Journal của lần chạy bị ngắt: đưa vào manifest rồi mới bắt đầu journal mới
+                if manifest.replay_journal(journal.path):
+                    manifest.save()
+            # Danh sách thumbnail đã có trên đĩa: đọc một lần, sau đó kiểm tra tồn tại trong bộ nhớ
+            self.store.load_index()
+            if self.dedupe:
+                self.phash_index = PerceptualHashIndex(self.phash_index_path, fingerprint, self.dedupe_max_distance)
+            journal.open(truncate=True)
             
             print(f"Bắt đầu tạo thumbnail...")
             start_time = time.time()
             
-            # Tạo list các coroutines
-            tasks = []
-            for idx, row in df.iterrows():
-                task = self.create_thumbnail_async(row['url'], row['title'])
-                tasks.append((idx, task))
-            
-            # Chạy tất cả tasks với asyncio.gather
-            print(f"🚀 Bắt đầu xử lý {len(tasks)} video với {self.concurrent_limit} concurrent...")
-            
-            # Chạy concurrent với progress tracking
-            results = []
             completed = 0
             success_count = 0
             failed_count = 0
+            skipped_count = 0
             
-            print(f"\n📊 Tổng số video cần xử lý: {len(tasks)}")
-            
-            # Chia nhỏ thành batches để theo dõi tiến trình
-            batch_size = self.concurrent_limit
-            for i in range(0, len(tasks), batch_size):
-                batch = tasks[i:i + batch_size]
-                batch_tasks = [task for idx, task in batch]
-                
-                # Chạy batch hiện tại
-                batch_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-                
-                # Xử lý kết quả batch
-                for j, (idx, _) in enumerate(batch):
-                    result = batch_results[j]
-                    completed += 1
-                    
-                    if isinstance(result, Exception):
-                        result = {"success": False, "thumbnail_path": None, "error": str(result)}
-                    
-                    # Tạo row data
-                    row_data = df.iloc[idx].to_dict()
-                    
-                    if result['success']:
-                        row_data['thumbnail_path'] = result['thumbnail_path']
-                        row_data['thumbnail_name'] = os.path.basename(result['thumbnail_path'])
-                        row_data['web_path'] = result['web_path']
+            def pending_rows():
+                """Đọc dần CSV, bỏ qua các video đã có thumbnail hợp lệ ở chế độ incremental"""
+                nonlocal skipped_count
+                for idx, row in self.iter_csv_rows(csv_file_path):
+                    if not self.in_shard(row['url']):
+                        continue
+                    if self.is_sharded:
+                        # Vị trí dòng trong input gốc để bước merge ghép lại đúng thứ tự
+                        row['source_index'] = idx
+                    if manifest is not None and not manifest.needs_processing(row['url'], fingerprint, exists=self.store.exists,
+                                                                              required_columns=required_columns):
+                        entry = manifest.get(row['url'])
+                        columns = entry.get('columns', {})
+                        row_data = dict(row)
+                        row_data['thumbnail_path'] = entry['thumbnail_path']
+                        row_data['thumbnail_name'] = os.path.basename(ThumbnailManifest.resolve_path(entry['thumbnail_path']))
+                        row_data['web_path'] = entry['web_path']
+                        row_data.update(columns)
                         row_data['status'] = 'success'
                         row_data['error'] = ''
-                        success_count += 1
-                    else:
-                        row_data['thumbnail_path'] = ''
-                        row_data['thumbnail_name'] = ''
-                        row_data['web_path'] = ''
-                        row_data['status'] = 'failed'
-                        row_data['error'] = result['error']
-                        failed_count += 1
-                    
-                    results.append(row_data)
+                        row_data['error_category'] = ''
+                        journal.append({"idx": idx, "row": row_data, "fingerprint": fingerprint, "columns": columns})
+                        skipped_count += 1
+                        self.metrics.record_job("skipped")
+                        continue
+                    yield idx, row
+            
+            print(f"🚀 Bắt đầu xử lý với {self.current_concurrency} concurrent (cửa sổ trượt)...")
+            print(f"\n📊 Tổng số video trong input: {total}")
+            
+            report_every = self.concurrent_limit
+            async for idx, row, result in self.iter_results_async(pending_rows()):
+                completed += 1
+                row_data = dict(row)
+                columns = self._extra_result_columns(result)
                 
-                # Progress update
-                progress = (completed / len(tasks)) * 100
-                elapsed = time.time() - start_time
-                rate = completed / elapsed if elapsed > 0 else 0
-                eta = (len(tasks) - completed) / rate if rate > 0 else 0
+                if result['success']:
+                    row_data['thumbnail_path'] = result['thumbnail_path']
+                    row_data['thumbnail_name'] = os.path.basename(result['thumbnail_path'])
+                    row_data['web_path'] = result['web_path']
+                    row_data.update(columns)
+                    row_data['status'] = 'success'
+                    row_data['error'] = ''
+                    row_data['error_category'] = ''
+                    self.store.add(result['thumbnail_path'], result.get('sprite_path'))
+                    success_count += 1
+                else:
+                    row_data['thumbnail_path'] = ''
+                    row_data['thumbnail_name'] = ''
+                    row_data['web_path'] = ''
+                    row_data['status'] = 'failed'
+                    row_data['error'] = result['error']
+                    row_data['error_category'] = result.get('error_category', '')
+                    failed_count += 1
                 
-                print(f"📈 Tiến trình: {completed}/{len(tasks)} ({progress:.1f}%) - " 
-                      f"Thành công: {success_count} - Thất bại: {failed_count} - "
-                      f"Tốc độ: {rate:.1f} video/s - ETA: {eta:.0f}s")
+                # Ghi nối kết quả ngay khi job xong (journal cũng là checkpoint để resume)
+                journal.append({"idx": idx, "row": row_data, "fingerprint": fingerprint, "columns": columns})
+                if manifest is not None:
+                    manifest.update(row_data['url'], result, fingerprint, columns=columns)
+                self.metrics.record_job(row_data['status'])
+                if self.metrics_path and time.time() - last_metrics_write >= self.metrics_interval:
+                    self.write_metrics()
+                    last_metrics_write = time.time()
                 
-                # Lưu kết quả tạm thời sau mỗi batch
-                if completed % (batch_size * 2) == 0 or completed == len(tasks):
-                    temp_df = pd.DataFrame(results)
-                    self.save_results_to_csv(temp_df, "vid.csv")
-                    print(f"💾 Đã lưu {completed}/{len(tasks)} kết quả vào vid.csv (Thành công: {success_count}, Thất bại: {failed_count})")
+                # Progress update
+                if completed % report_every == 0:
+                    remaining = max(total - skipped_count - completed, 0)
+                    progress = ((completed + skipped_count) / total) * 100 if total else 100.0
+                    elapsed = time.time() - start_time
+                    rate = completed / elapsed if elapsed > 0 else 0
+                    eta = remaining / rate if rate > 0 else 0
+                    
+                    print(f"📈 Tiến trình: {completed + skipped_count}/{total} ({progress:.1f}%) - " 
+                          f"Thành công: {success_count} - Thất bại: {failed_count} - "
+                          f"Tốc độ: {rate:.1f} video/s - Concurrent: {self.current_concurrency} - ETA: {eta:.0f}s")
             
             end_time = time.time()
             
-            # Tạo DataFrame kết quả
-            result_df = pd.DataFrame(results)
+            # Compact journal một lần thành CSV kết quả (giữ thứ tự như CSV input)
+            result_df = journal.load_rows()
+            if result_df.empty:
+                print("❌ CSV không có video nào")
+                return result_df
+            if self.thumbnail_packs is not None:
+                result_df = self.thumbnail_packs.build(result_df)
+            self.save_results_to_csv(result_df, output_csv_path)
+            if self.gallery_index is not None:
+                self.gallery_index.build(result_df)
+            if manifest is not None:
+                manifest.save()
+            if self.phash_index is not None:
+                self.phash_index.save()
+            journal.remove()
             
-            # Thống kê
-            success_count = len(result_df[result_df['status'] == 'success'])
-            failed_count = len(result_df[result_df['status'] == 'failed'])
+            # Thống kê (đếm dần trong lúc chạy, không đếm lại trên DataFrame)
+            processed_total = completed + skipped_count
+            total_success = success_count + skipped_count
+            duration = end_time - start_time
             
             print(f"\n=== KẾT QUẢ XỬ LÝ ===")
-            print(f"📊 Tổng số video đã xử lý: {len(df)} video")
-            print(f"✅ Thành công: {success_count}/{len(df)} video ({success_count/len(df)*100:.1f}%)")
-            print(f"❌ Thất bại: {failed_count}/{len(df)} video ({failed_count/len(df)*100:.1f}%)")
-            print(f"⏱️  Thời gian xử lý: {end_time - start_time:.2f} giây")
-            print(f"🚀 Tốc độ trung bình: {len(df)/(end_time - start_time):.2f} video/giây")
-            print(f"🔄 Concurrent limit: {self.concurrent_limit}")
+            print(f"📊 Tổng số video đã xử lý: {processed_total} video")
+            if manifest is not None:
+                print(f"⏭️  Bỏ qua (đã có thumbnail): {skipped_count} video")
+            print(f"✅ Thành công: {total_success}/{processed_total} video ({total_success/processed_total*100:.1f}%)")
+            if self.phash_index is not None:
+                duplicate_count = sum(1 for value in result_df.get('is_duplicate', []) if value is True or value == 'True')
+                print(f"♻️ Video trùng (dùng lại thumbnail): {duplicate_count} video")
+            print(f"❌ Thất bại: {failed_count}/{processed_total} video ({failed_count/processed_total*100:.1f}%)")
+            timeout_count = sum(count for (category, _), count in self.metrics.errors.items() if category == "timeout")
+            if timeout_count:
+                killed = self._decode_pool.killed if self._decode_pool is not None else 0
+                print(f"⏰ Quá deadline: {timeout_count} video (kill {killed} worker decode)")
+            print(f"⏱️  Thời gian xử lý: {duration:.2f} giây")
+            print(f"🚀 Tốc độ trung bình: {completed/duration if duration > 0 else 0:.2f} video/giây")
+            print(f"🔄 Concurrent limit: {self.current_concurrency}")
+            if self.adaptive_concurrency:
+                print(f"🎚️  Số lần điều chỉnh concurrency: {len(self.semaphore.history)}")
+            for stage, stats in self.metrics.summary()["stages"].items():
+                print(f"   ⏱️  {stage}: p50 {stats['p50_ms']:.1f}ms - p95 {stats['p95_ms']:.1f}ms - tổng {stats['total_s']:.2f}s")
             
             return result_df
             
         except Exception as e:
             print(f"Lỗi khi xử lý CSV async: {str(e)}")
             return None
+        finally:
+            # Khi bị ngắt giữa chừng: journal được fsync và giữ lại để lần chạy sau resume tiếp
+            if journal is not None:
+                journal.close()
+            if manifest is not None:
+                manifest.save()
+            if self.phash_index is not None:
+                self.phash_index.save()
+                self.phash_index = None
+            if self.metrics_path:
+                self.write_metrics()
+            await self.close_async()
     
-    def save_results_to_csv(self, result_df, output_csv_path="vid.csv"):
+    def write_metrics(self):
+        """Ghi metrics hiện tại ra metrics_path (JSON) và file .prom cùng tên"""
+        try:
+            prom_path = os.path.splitext(self.metrics_path)[0] + ".prom"
+            self.metrics.write(self.metrics_path, prom_path)
+        except Exception as e:
+            print(f"⚠️ Không ghi được metrics {self.metrics_path}: {str(e)}")
+    
+    @staticmethod
+    def save_results_to_csv(result_df, output_csv_path="vid.csv"):
         """
         Lưu kết quả vào CSV
         
@@ -364,15 +3203,15 @@ class VideoThumbnailGenerator:
         """
         try:
             # Sắp xếp cột
-            columns_order = ['url', 'title', 'thumbnail_name', 'web_path', 'thumbnail_path', 'status', 'error']
+            columns_order = ['url', 'title', 'thumbnail_name', 'web_path', 'thumbnail_path', 'status', 'error', 'error_category']
             existing_columns = [col for col in columns_order if col in result_df.columns]
             other_columns = [col for col in result_df.columns if col not in columns_order]
             final_columns = existing_columns + other_columns
             
             result_df_ordered = result_df[final_columns]
             
-            # Lưu file
-            result_df_ordered.to_csv(output_csv_path, index=False, encoding='utf-8')
+            # Lưu file tạm rồi rename để không bao giờ để lại CSV bị ghi dở
+            _atomic_write(output_csv_path, result_df_ordered.to_csv(index=False).encode('utf-8'))
             print(f"✓ Đã lưu kết quả vào: {output_csv_path}")
             
             # Thống kê
@@ -385,8 +3224,97 @@ class VideoThumbnailGenerator:
         except Exception as e:
             print(f"Lỗi khi lưu CSV: {str(e)}")
 
-async def process_vid_txt():
-    """Xử lý file vid.txt và lưu kết quả vào vid.csv"""
+
+def merge_shard_results(input_csv_path, shard_csv_paths, output_csv_path="vid.csv",
+                        manifest_path=None, shard_manifest_paths=()):
+    """
+    Ghép kết quả của các shard thành CSV kết quả chung theo đúng thứ tự input
+    
+    Phát hiện dòng thiếu (không shard nào có kết quả, hoặc URL không khớp input) và dòng trùng
+    (nhiều kết quả cho cùng một dòng input - ưu tiên kết quả success). Dòng thiếu được ghi với
+    status failed để lần chạy incremental sau xử lý lại.
+    
+    Args:
+        input_csv_path (str): File input gốc (vid.txt)
+        shard_csv_paths (list): Các file kết quả shard (vid.shard-XX-of-YY.csv)
+        output_csv_path (str): File CSV kết quả chung
+        manifest_path (str): Manifest chung để gộp manifest của các shard vào (None = bỏ qua)
+        shard_manifest_paths (list): Manifest của các shard, theo thứ tự shard_index
+    
+    Returns:
+        dict: {"rows", "missing", "duplicates", "mismatched", "missing_files"}
+    """
+    shard_rows = {}
+    duplicates = []
+    mismatched = []
+    missing_files = []
+    for path in shard_csv_paths:
+        if not os.path.exists(path):
+            missing_files.append(path)
+            continue
+        for row in pd.read_csv(path, dtype=str, keep_default_na=False).to_dict('records'):
+            if not row.get('source_index', '').isdigit():
+                print(f"⚠️ {path}: dòng không có source_index, bỏ qua ({row.get('url')})")
+                continue
+            idx = int(row.pop('source_index'))
+            existing = shard_rows.get(idx)
+            if existing is not None:
+                duplicates.append(idx)
+                if existing.get('status') == 'success':
+                    continue
+            shard_rows[idx] = row
+    
+    merged = []
+    missing = []
+    for idx, row in VideoThumbnailGenerator.iter_csv_rows(input_csv_path):
+        result = shard_rows.pop(idx, None)
+        if result is not None and result.get('url') != row['url']:
+            mismatched.append(idx)
+            result = None
+        if result is None:
+            missing.append(idx)
+            result = dict(row, thumbnail_name='', web_path='', thumbnail_path='', status='failed',
+                          error='Không có kết quả trong các file shard', error_category='missing')
+        merged.append(result)
+    # Kết quả shard trỏ tới dòng không tồn tại trong input (input đã đổi sau khi chạy shard)
+    mismatched.extend(sorted(shard_rows))
+    
+    if merged:
+        VideoThumbnailGenerator.save_results_to_csv(pd.DataFrame(merged, dtype=object), output_csv_path)
+    
+    if manifest_path:
+        manifest = ThumbnailManifest(manifest_path)
+        shard_count = len(shard_manifest_paths)
+        for shard_index, path in enumerate(shard_manifest_paths):
+            if os.path.exists(path):
+                # Chỉ lấy URL mà shard này thực sự xử lý: entry của shard khác (vd: nhập từ vid.csv cũ) đã lỗi thời
+                manifest.entries.update({
+                    url: entry for url, entry in ThumbnailManifest(path).entries.items()
+                    if VideoThumbnailGenerator.shard_of(url, shard_count) == shard_index
+                })
+        manifest.save()
+    
+    print(f"\n=== GHÉP KẾT QUẢ SHARD ===")
+    print(f"📊 Tổng số dòng: {len(merged)}")
+    if missing_files:
+        print(f"❌ Thiếu file shard: {', '.join(missing_files)}")
+    print(f"{'❌' if missing else '✅'} Dòng thiếu kết quả: {len(missing)}" + (f" (vd: {missing[:10]})" if missing else ""))
+    print(f"{'⚠️' if duplicates else '✅'} Dòng trùng giữa các shard: {len(duplicates)}" + (f" (vd: {duplicates[:10]})" if duplicates else ""))
+    if mismatched:
+        print(f"⚠️ Dòng không khớp input: {len(mismatched)} (vd: {mismatched[:10]})")
+    
+    return {"rows": len(merged), "missing": missing, "duplicates": duplicates,
+            "mismatched": mismatched, "missing_files": missing_files}
+
+
+async def process_vid_txt(shard_index=None, shard_count=1):
+    """
+    Xử lý file vid.txt và lưu kết quả vào vid.csv
+    
+    Args:
+        shard_index (int): Chỉ số shard khi chia việc cho nhiều máy (None = xử lý toàn bộ)
+        shard_count (int): Tổng số shard; kết quả ghi vào vid.shard-XX-of-YY.csv, ghép lại bằng --merge
+    """
     try:
         # Đọc file vid.txt
         input_file = "public/vid.txt"
@@ -406,47 +3334,19 @@ async def process_vid_txt():
         
         print(f"Đọc file: {input_file}")
         
-        # Đọc CSV trực tiếp bằng pandas với nhiều cách khác nhau
+        # Chỉ đọc header để kiểm tra cột; các dòng được đọc dần theo chunk trong process_csv_batch_async
+        # (thiếu cột title thì iter_csv_rows tự thêm title rỗng)
         try:
-            # Cách 1: Đọc bằng pandas với các tham số chuẩn
-            df = pd.read_csv(input_file)
-            print(f"✅ Đã đọc thành công file CSV với {len(df)} dòng")
-        except Exception as e1:
-            print(f"❌ Lỗi khi đọc file CSV (cách 1): {str(e1)}")
-            
-            try:
-                # Cách 2: Đọc bằng pandas với các tham số nâng cao
-                df = pd.read_csv(input_file, encoding='utf-8', escapechar='\\', quotechar='"', on_bad_lines='skip')
-                print(f"✅ Đã đọc thành công file CSV (cách 2) với {len(df)} dòng")
-            except Exception as e2:
-                print(f"❌ Lỗi khi đọc file CSV (cách 2): {str(e2)}")
-                
-                try:
-                    # Cách 3: Đọc thủ công bằng csv module
-                    import csv
-                    rows = []
-                    with open(input_file, 'r', encoding='utf-8') as f:
-                        reader = csv.reader(f)
-                        header = next(reader)  # Đọc header
-                        for row in reader:
-                            if len(row) >= 2:  # Đảm bảo có ít nhất 2 cột
-                                rows.append({"url": row[0], "title": row[1] if len(row) > 1 else ""})
-                    
-                    df = pd.DataFrame(rows)
-                    print(f"✅ Đã đọc thành công file CSV (cách 3) với {len(df)} dòng")
-                except Exception as e3:
-                    print(f"❌ Lỗi khi đọc file CSV (cách 3): {str(e3)}")
-                    return
+            columns = pd.read_csv(input_file, nrows=0).columns
+        except Exception as e:
+            print(f"❌ Lỗi khi đọc header file CSV: {str(e)}")
+            return
         
         # Kiểm tra cột url
-        if 'url' not in df.columns:
+        if 'url' not in columns:
             print("❌ File vid.txt không có cột url")
             return
         
-        # Đảm bảo có cột title
-        if 'title' not in df.columns:
-            df['title'] = ''
-        
         # Khởi tạo generator
         try:
             output_dir = "public/thumbnails"
@@ -463,20 +3363,39 @@ async def process_vid_txt():
             generator = VideoThumbnailGenerator(
                 output_dir=output_dir,
                 thumbnail_size=(320, 180),  # 16:9 aspect ratio
-                concurrent_limit=10,  # Giảm xuống để tránh quá tải
-                web_path_prefix="/temporary/thumbnails/"
+                concurrent_limit=10,  # Giá trị khởi đầu, tự điều chỉnh theo latency/lỗi của CDN
+                adaptive_concurrency=True,
+                min_concurrency=4,
+                max_concurrency=48,
+                web_path_prefix="/temporary/thumbnails/",
+                manifest_path="vid_manifest.json",
+                executor_backend="process",  # Resize/encode chạy song song trên tất cả CPU core
+                decode_backend="process",  # Decode trong worker có watchdog: URL treo bị kill, không chiếm slot
+                video_timeout=90.0,
+                storage_layout="hashed",  # Tên file ổn định theo hash URL, chia thư mục con ab/cd/
+                metrics_path="vid_metrics.json",  # Thời gian từng stage, byte, lỗi (kèm vid_metrics.prom)
+                shard_index=shard_index,
+                shard_count=shard_count,
+                gallery_index_dir="public/vid-index",  # Index phân trang cho VideoGallery.js
+                gallery_index_url_prefix="/temporary/vid-index/",
+                pack_dir="public/vid-packs",  # Mỗi trang gallery tải thumbnail bằng một request
+                pack_url_prefix="/temporary/vid-packs/"
             )
         except Exception as e:
             print(f"❌ Lỗi khi khởi tạo generator: {str(e)}")
             return
         
         # Xử lý CSV
-        result_df = await generator.process_csv_batch_async(csv_file_path=input_file)
+        # Chế độ incremental: chỉ xử lý video mới/lỗi/mất file, lần đầu nhập manifest từ vid.csv cũ
+        result_df = await generator.process_csv_batch_async(
+            csv_file_path=input_file,
+            incremental=True,
+            seed_csv_path=output_csv,
+            output_csv_path=generator.shard_path(output_csv, shard_index, shard_count) if generator.is_sharded else output_csv
+        )
         
         if result_df is not None:
-            # Lưu kết quả vào CSV mới
-            generator.save_results_to_csv(result_df, output_csv)
-            
+            # vid.csv đã được ghi (compact từ journal) trong process_csv_batch_async
             # Tính tổng số thành công và thất bại
             success_count = len(result_df[result_df['status'] == 'success'])
             failed_count = len(result_df[result_df['status'] == 'failed'])
@@ -492,6 +3411,31 @@ async def process_vid_txt():
         print(f"❌ Lỗi: {str(e)}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tạo thumbnail cho các video trong vid.txt")
+    parser.add_argument("--shard-index", type=int, default=None, help="Chỉ số shard của máy này (0 .. shard-count - 1)")
+    parser.add_argument("--shard-count", type=int, default=1, help="Tổng số shard (số máy chia việc)")
+    parser.add_argument("--merge", action="store_true",
+                        help="Ghép vid.shard-XX-of-YY.csv của tất cả shard thành vid.csv (cần --shard-count)")
+    args = parser.parse_args()
+    
+    if args.merge:
+        shard_ids = range(args.shard_count)
+        input_file = "public/vid.txt" if os.path.exists("public/vid.txt") else "vid.txt"
+        report = merge_shard_results(
+            input_file,
+            [VideoThumbnailGenerator.shard_path("vid.csv", i, args.shard_count) for i in shard_ids],
+            output_csv_path="vid.csv",
+            manifest_path="vid_manifest.json",
+            shard_manifest_paths=[VideoThumbnailGenerator.shard_path("vid_manifest.json", i, args.shard_count) for i in shard_ids]
+        )
+        if report["rows"]:
+            merged_df = ThumbnailPackBuilder("public/vid-packs", "/temporary/vid-packs/").build(
+                pd.read_csv("vid.csv", dtype=str, keep_default_na=False)
+            )
+            VideoThumbnailGenerator.save_results_to_csv(merged_df, "vid.csv")
+            GalleryIndexBuilder("public/vid-index", "/temporary/vid-index/").build(merged_df)
+        sys.exit(1 if report["missing"] or report["missing_files"] else 0)
+    
     # Lấy thời gian bắt đầu để tính tổng thời gian chạy
     start_time = datetime.now()
     print(f"=== BẮT ĐẦU CHẠY SCRIPT THUMBNAIL ({start_time.strftime('%Y-%m-%d %H:%M:%S')}) ===")
@@ -522,11 +3466,11 @@ if __name__ == "__main__":
     try:
         print("🔥 Bắt đầu xử lý video thumbnails...")
         print("\n📊 Thông tin quá trình xử lý sẽ được hiển thị trong quá trình chạy...\n")
-        asyncio.run(process_vid_txt())
+        asyncio.run(process_vid_txt(args.shard_index, args.shard_count))
     except AttributeError:
         # Python < 3.7
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(process_vid_txt())
+        loop.run_until_complete(process_vid_txt(args.shard_index, args.shard_count))
     except Exception as e:
         print(f"❌ Lỗi khi chạy script: {str(e)}")
     finally: